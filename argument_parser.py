@@ -1,10 +1,13 @@
 import argparse
-import re
+import functools
 import numpy
 import tensorflow as tf
 import tflowtools as TFT
 import mnist_basics
 import math
+import gann_base
+import data_cache
+import data_prep
 
 class argument_parser():
     # parses arguments given on command line
@@ -12,7 +15,8 @@ class argument_parser():
     def __init__(self):
         self.source_is_called = False
 
-    def parse(self):
+    # args is a list of command-line arguments, by default those of this process (sys.argv[1:]).
+    def parse(self, args=None):
         parser = argparse.ArgumentParser()
         parser.add_argument("-d", "--dims", nargs='+', type=int, required=True,
                 help="dimensions of the neural network")
@@ -21,6 +25,23 @@ class argument_parser():
                 Will crash if incorrect or wrong number of values are given")
         parser.add_argument("-s", "--source", required=True,
                 help="data source")
+        parser.add_argument("--cache", action='store_true', required=False, \
+                help="load the data set from (or save it to) the disk cache, keyed by source, sourceinit, --missing")
+        parser.add_argument("--stream", action='store_true', required=False, \
+                help="stream the cases from disk in chunks instead of loading them all. For <file>.txt sources, or \
+                <name>.npy for the pair data_set_files/<name>-features.npy and <name>-targets.npy")
+        parser.add_argument("--onthefly", action='store_true', required=False, \
+                help="generate fresh training cases on the fly, with fixed validation and test sets. For parity, \
+                bitcounter, segmentcounter, symmetry and auto_dense")
+        parser.add_argument("--producer", required=False, \
+                help="where on-the-fly cases are generated: none (between steps), thread or process. Default is none")
+        parser.add_argument("--normalize", required=False, \
+                help="normalization of the input features: minmax, zscore or none. Default is minmax for .txt sources \
+                and none otherwise")
+        parser.add_argument("--missing", type=float, required=False, \
+                help="value used for missing (?) fields in .txt sources. Default is 0")
+        parser.add_argument("--parseprocs", type=int, required=False, \
+                help="number of processes that parse a .txt source. Default is 1")
         parser.add_argument("-a", "--afunc", required=True, \
                 help="activation function of hidden layers")
         parser.add_argument("--ofunc", required=True, \
@@ -39,10 +60,51 @@ class argument_parser():
                 help="validation fraction")
         parser.add_argument("--tfrac", type=float, required=False, \
                 help="test fraction")
+        parser.add_argument("--folds", type=int, required=False, \
+                help="k-fold cross-validation: cut the cases into this many stratified folds and hold one out")
+        parser.add_argument("--fold", type=int, required=False, \
+                help="number (from 0) of the fold that is held out for validation and testing. Default is 0")
         parser.add_argument("--vint", type=int, required=False, \
                 help="number of training minibatches to use between each validation test")
         parser.add_argument("--mbs", type=int, required=True, \
                 help="number of cases in a minibatch")
+        parser.add_argument("--replace", action='store_true', required=False, \
+                help="sample minibatches with replacement instead of walking through shuffled epochs")
+        parser.add_argument("--epoch", type=int, required=False, \
+                help="number of training cases in one epoch of minibatch sampling. Default is all training cases")
+        parser.add_argument("--pipeline", action='store_true', required=False, \
+                help="feed cases through a prefetching tf.data pipeline instead of feed_dicts")
+        parser.add_argument("--fused", type=int, required=False, \
+                help="number of training steps to run inside the graph per session call. Default is 1")
+        parser.add_argument("--towers", type=int, required=False, \
+                help="number of network replicas that each train on a share of every minibatch. Default is 1")
+        parser.add_argument("--ensemble", type=int, required=False, \
+                help="number of independent networks (same dims) trained side by side and averaged. Default is 1")
+        parser.add_argument("--bootstrap", action='store_true', required=False, \
+                help="train each network of an ensemble on its own resample of every minibatch")
+        parser.add_argument("--precision", required=False, \
+                help="float type of the network: float32 or float64. Default is float64")
+        parser.add_argument("--storage", required=False, \
+                help="float type used to store the cases: float16, float32 or float64. Default is the network's type")
+        parser.add_argument("--asyncval", action='store_true', required=False, \
+                help="run validation tests on a background thread, on snapshots of the weights")
+        parser.add_argument("--ckint", type=int, required=False, \
+                help="number of training steps between periodic checkpoints. Default is no periodic checkpoints")
+        parser.add_argument("--ckkeep", type=int, required=False, \
+                help="number of periodic checkpoints to keep on disk. Default is 5")
+        parser.add_argument("--keepsession", action='store_true', required=False, \
+                help="keep the session alive between training and mapping instead of saving and restoring the weights")
+        parser.add_argument("--intra", type=int, required=False, \
+                help="number of threads that TensorFlow uses within an op. Default is 0 (one per core)")
+        parser.add_argument("--inter", type=int, required=False, \
+                help="number of threads that TensorFlow uses to run independent ops. Default is 0 (one per core)")
+        parser.add_argument("--affinity", nargs='+', type=int, required=False, \
+                help="list of the CPUs that the run may use (Linux only). Default is all of them")
+        parser.add_argument("--optlevel", type=int, required=False, \
+                help="graph optimization level: 0 (none) or 1 (common subexpressions and constant folding). \
+                Default is TensorFlow's")
+        parser.add_argument("--xla", action='store_true', required=False, \
+                help="compile the graph with the XLA just-in-time compiler")
         parser.add_argument("--mapbs", type=int, required=False, \
                 help="number of training cases to be used for a map test. Zero indicates no map test")
         parser.add_argument("--steps", type=int, required=True, \
@@ -55,14 +117,22 @@ class argument_parser():
                 help="list of the weight matrices to be visualized at the end of run")
         parser.add_argument("--dispb", nargs='*', type=int, required=False, \
                 help="list of bias matrices to be visualized at the end or run")
+        parser.add_argument("--probeint", type=int, required=False, \
+                help="number of training steps between writes of the tensorboard probes. Default is 1")
+        parser.add_argument("--probesample", type=int, required=False, \
+                help="steps between samples of histogram probes into a reservoir that is written every probeint steps")
         parser.add_argument("--usevsi", action='store_true', required=False, \
                 help="use variance_scaling_initializer to initialize weights")
         parser.add_argument("--notbest1", action='store_false', required=False, \
                 help="don't use bestk=1 as evaluation function")
-        self.args = parser.parse_args()
+        self.args = parser.parse_args(args)
 
     def organize(self):
+        self.precision_v = self.precision()
+        self.storage_v = self.storage()  # The data set cache stores the cases in this type
         self.data_set_v = self.source()
+        self.normalizer_v = self.normalizer()
+        self.producer_v = self.producer()
         self.dims_v = self.dims()
         self.afunc_v = self.afunc()
         self.ofunc_v = self.ofunc()
@@ -73,14 +143,34 @@ class argument_parser():
         self.casefrac_v = self.casefrac()
         self.vfrac_v = self.vfrac()
         self.tfrac_v = self.tfrac()
+        self.folds_v = self.folds()
+        self.fold_v = self.fold()
         self.vint_v = self.vint()
+        self.asyncval_v = self.asyncval()
+        self.ckint_v = self.ckint()
+        self.ckkeep_v = self.ckkeep()
+        self.keepsession_v = self.keepsession()
+        self.intra_v = self.intra()
+        self.inter_v = self.inter()
+        self.affinity_v = self.affinity()
+        self.optlevel_v = self.optlevel()
+        self.xla_v = self.xla()
         self.mbs_v = self.mbs()
+        self.replace_v = self.replace()
+        self.epoch_v = self.epoch()
+        self.pipeline_v = self.pipeline()
+        self.fused_v = self.fused()
+        self.towers_v = self.towers()
+        self.ensemble_v = self.ensemble()
+        self.bootstrap_v = self.bootstrap()
         self.mapbs_v = self.mapbs()
         self.steps_v = self.steps()
         self.maplayers_v = self.maplayers()
         # self.mapdend_v = self.mapdend()
         self.dispw_v = self.dispw()
         self.dispb_v = self.dispb()
+        self.probeint_v = self.probeint()
+        self.probesample_v = self.probesample()
         self.usevsi_v = self.usevsi()
         self.best1_v = self.best1()
 
@@ -88,51 +178,101 @@ class argument_parser():
         if not self.source_is_called:
             print("source() must be called before dims() is called")
             quit()
-        self.args.dims = [len(self.data_set_v[0][0])] + self.args.dims + [len(self.data_set_v[0][1])]
+        if self.args.stream or self.args.onthefly:  # a reader or a case generator
+            num_inputs, num_outputs = self.data_set_v.num_inputs, self.data_set_v.num_outputs
+        elif isinstance(self.data_set_v, tuple):  # (features, targets) arrays
+            num_inputs, num_outputs = self.data_set_v[0].shape[1], self.data_set_v[1].shape[1]
+        else:  # list of [input, target] pairs
+            num_inputs, num_outputs = len(self.data_set_v[0][0]), len(self.data_set_v[0][1])
+        self.args.dims = [num_inputs] + self.args.dims + [num_outputs]
         print("dimensions:", self.args.dims)
         return self.args.dims
 
+    # With --cache, the data set is memory-mapped from the cache when it is there, and otherwise read as usual and
+    # written to the cache.  shuffled_v tells whether the cases already come in random order (as cached cases do).
     def source(self):
-        def normalize(cases):
-            input = [c[0] for c in cases]
-            target = [c[1] for c in cases]
-            input = numpy.array(input)
-            min_arr = numpy.min(input, axis=0)
-            max_arr = numpy.max(input, axis=0)
-            for element in input:
-                for i, e in enumerate(element):
-                    element[i] = (e - min_arr[i])/(max_arr[i] - min_arr[i])
-            return list(zip(input, target))
-
-        def to_float(inp):
-            # returns 0 if input is ? (questionmark)
-            return 0 if inp == '?' else float(inp)
-
         self.source_is_called = True
         print("source:", self.args.source)
+        self.shuffled_v = False
+        self.stream_v = self.args.stream
+        self.onthefly_v = self.args.onthefly
+        self.scale_v = 1 / 255 if self.args.source == "mnist" else None  # Pixels stay uint8 until batched
+        if self.args.stream:
+            return self.stream_source()
+        if self.args.onthefly:
+            return self.generator_source()
+        if not self.args.cache:
+            return self.read_source()
+        key = self.cache_key()
+        cases = data_cache.load_cases(key)
+        if cases is None:
+            features, targets = gann_base.gen_case_arrays(self.read_source(), self.storage_v,
+                                                          keep_features=self.scale_v is not None)
+            data_cache.dump_cases(key, features, targets)
+            cases = data_cache.load_cases(key)
+        else:
+            print("loaded from cache:", key)
+        self.shuffled_v = True
+        return cases
+
+    # The parse options that change the arrays read_source gives are part of the key.
+    def cache_key(self):
+        options = {'missing': self.missing()} if self.args.source[-4:] == ".txt" else None
+        return data_cache.cache_key(self.args.source, self.args.sourceinit, self.storage_v, options=options)
+
+    # With --stream, the data set is a reader that the streaming case manager pulls chunks of cases from.
+    def stream_source(self):
+        path = "data_set_files/" + self.args.source
+        if self.args.source[-4:] == ".txt":
+            return gann_base.Textreader(path, missing=self.missing())
+        elif self.args.source[-4:] == ".npy":
+            return gann_base.Npyreader(path[:-4] + "-features.npy", path[:-4] + "-targets.npy")
+        print(self.args.source, " can not be streamed. Use <filename>.txt or <name>.npy", sep="")
+        quit()
+
+    # With --onthefly, the data set is a case generator, whose nominal size is that of the data set that read_source
+    # would give for the same sourceinit.
+    def generator_source(self):
+        init = self.args.sourceinit
+        if self.args.source == "parity":
+            num_bits = 10 if init is None else init[0]
+            func, size = functools.partial(TFT.gen_random_parity_arrays, num_bits=num_bits), 2**num_bits
+        elif self.args.source == "symmetry":
+            vlen, size = (101, 2000) if init is None else (init[0], init[1])
+            func = functools.partial(TFT.gen_symvect_arrays, vlen, onehot=True)
+        elif self.args.source == "auto_dense":
+            size, vlen = (2000, 100) if init is None else (init[0], init[1])
+            func = functools.partial(TFT.gen_dense_autoencoder_arrays, size=vlen)
+        elif self.args.source == "bitcounter":
+            size, vlen = (500, 15) if init is None else (init[0], init[1])
+            func = functools.partial(TFT.gen_vector_count_arrays, size=vlen)
+        elif self.args.source == "segmentcounter":
+            vlen, size, minsegs, maxsegs = (25, 1000, 0, 8) if init is None else (init[0], init[1], init[2], init[3])
+            func = functools.partial(TFT.gen_segmented_vector_arrays, vlen, minsegs=minsegs, maxsegs=maxsegs)
+        else:
+            print(self.args.source, " can not be generated on the fly. \
+                        Use parity, symmetry, auto_dense, bitcounter or segmentcounter", sep="")
+            quit()
+        return gann_base.Casegenerator(func, size)
+
+    def read_source(self):
         data_set = []
         if self.args.source[-4:] == ".txt":
-            with open("data_set_files/" + self.args.source) as file:
-                data = list(map(lambda x: re.split("[;,]", x), file.readlines()))
-                data = list(map(lambda x: list(map(to_float, x)), data))
-            max_d = max(map(lambda x: int(x[-1]), data))
-            for element in data:
-                input = element[:-1]
-                target = TFT.int_to_one_hot(int(element[-1])-1, max_d)
-                data_set.append([input, target])
+            data = data_prep.load_delimited("data_set_files/" + self.args.source, missing=self.missing(),
+                        processes=self.parseprocs())
+            features, labels = data_prep.split_labels(data)
+            data_set = (features, numpy.eye(labels.max() + 1)[labels])
         elif self.args.source == "parity":
             if self.args.sourceinit is None:
-                data_set = TFT.gen_all_parity_cases(10)
+                data_set = TFT.gen_parity_arrays(10)
             else:
-                data_set = TFT.gen_all_parity_cases(self.args.sourceinit[0])
+                data_set = TFT.gen_parity_arrays(self.args.sourceinit[0])
         elif self.args.source == "symmetry":
             if self.args.sourceinit is None:
-                vecs = TFT.gen_symvect_dataset(101, 2000)
+                features, labels = TFT.gen_symvect_arrays(101, 2000)
             else:
-                vecs = TFT.gen_symvect_dataset(self.args.sourceinit[0], self.args.sourceinit[1])
-            inputs = list(map(lambda x: x[:-1], vecs))
-            targets = list(map(lambda x: TFT.int_to_one_hot(x[-1], 2), vecs))
-            data_set = list(zip(inputs, targets))
+                features, labels = TFT.gen_symvect_arrays(self.args.sourceinit[0], self.args.sourceinit[1])
+            data_set = (features, numpy.eye(2)[labels])
         elif self.args.source == "auto_onehot":
             if self.args.sourceinit is None:
                 data_set = TFT.gen_all_one_hot_cases(64)
@@ -140,38 +280,66 @@ class argument_parser():
                 data_set = TFT.gen_all_one_hot_cases(self.args.sourceinit[0])
         elif self.args.source == "auto_dense":
             if self.args.sourceinit is None:
-                data_set = TFT.gen_dense_autoencoder_cases(2000, 100)
+                data_set = TFT.gen_dense_autoencoder_arrays(2000, 100)
             else:
-                data_set = TFT.gen_dense_autoencoder_cases(self.args.sourceinit[0], self.args.sourceinit[1])
+                data_set = TFT.gen_dense_autoencoder_arrays(self.args.sourceinit[0], self.args.sourceinit[1])
         elif self.args.source == "bitcounter":
             if self.args.sourceinit is None:
-                data_set = TFT.gen_vector_count_cases(500, 15)
+                data_set = TFT.gen_vector_count_arrays(500, 15)
             else:
-                data_set = TFT.gen_vector_count_cases(self.args.sourceinit[0], self.args.sourceinit[1])
+                data_set = TFT.gen_vector_count_arrays(self.args.sourceinit[0], self.args.sourceinit[1])
         elif self.args.source == "segmentcounter":
             if self.args.sourceinit is None:
-                data_set = TFT.gen_segmented_vector_cases(25, 1000, 0, 8)
+                data_set = TFT.gen_segmented_vector_arrays(25, 1000, 0, 8)
             else:
-                data_set = TFT.gen_segmented_vector_cases(self.args.sourceinit[0], \
+                data_set = TFT.gen_segmented_vector_arrays(self.args.sourceinit[0], \
                             self.args.sourceinit[1], self.args.sourceinit[2], self.args.sourceinit[3])
         elif self.args.source == "mnist":
-            # mnist_basics.load_all_flat_cases(type='testing')
-            cases = mnist_basics.load_all_flat_cases(type='training')
-            input = cases[0]
-            target = cases[1]
-            input = list(map(lambda x: list(map(lambda e: e/255, x)), input))
-            target = list(map(lambda x: TFT.int_to_one_hot(x, 10), target))
-            data_set = list(zip(input, target))
+            # mnist_basics.load_flat_mnist('testing')
+            features, labels = mnist_basics.load_flat_mnist('training')
+            data_set = (features, numpy.eye(10)[labels])
 
         if data_set == []:
             print(self.args.source, " is illegal for argument --source")
             print("Legal values are: <filenme>.txt, parity, symmetry, \
                         auto_onehot, auto_dense, bitcounter, segmentcounter", sep="")
             quit()
-        if self.args.source[-4:] == ".txt":
-            data_set = normalize(data_set)
         return data_set
 
+    # missing() and parseprocs() are only used (and printed) while reading a .txt source.
+    def missing(self):
+        print("missing value:", self.args.missing if self.args.missing is not None else 0)
+        return self.args.missing if self.args.missing is not None else 0
+
+    def parseprocs(self):
+        print("parsing processes:", self.args.parseprocs if self.args.parseprocs is not None else 1)
+        return self.args.parseprocs if self.args.parseprocs is not None else 1
+
+    # The normalizer is fitted by the case manager, to the training cases only.
+    def normalizer(self):
+        mode = self.args.normalize
+        if mode is None:
+            mode = "minmax" if self.args.source[-4:] == ".txt" else "none"
+        print("normalization:", mode)
+        if mode == "none":
+            return None
+        elif mode in ("minmax", "zscore"):
+            return data_prep.Normalizer(mode)
+        else:
+            print("'", mode, "' is invalid for argument --normalize", sep="")
+            print("Valid arguments are: minmax, zscore, none")
+            quit()
+
+    def producer(self):
+        if not self.args.onthefly: return None
+        producer = self.args.producer if self.args.producer is not None else "none"
+        print("case producer:", producer)
+        if producer not in ("none", "thread", "process"):
+            print("'", producer, "' is invalid for argument --producer", sep="")
+            print("Valid arguments are: none, thread, process")
+            quit()
+        return None if producer == "none" else producer
+
     def afunc(self):
         print("activation function:", self.args.afunc)
         dict = {"sigmoid": tf.nn.sigmoid, "relu": tf.nn.relu, "relu6": tf.nn.relu6, "elu": tf.nn.elu,
@@ -247,14 +415,135 @@ class argument_parser():
         #     quit()
         return self.args.tfrac if self.args.tfrac is not None else 0.1
 
+    def folds(self):
+        print("folds:", self.args.folds)
+        if self.args.folds is not None:
+            if self.args.folds < 2:
+                print("--folds must be at least 2")
+                quit()
+            if self.args.stream or self.args.onthefly:
+                print("--folds can not be combined with --stream or --onthefly")
+                quit()
+            # The folds of a cross-validation must partition one data set, but these sources draw a new one each run
+            if self.args.source in ("symmetry", "auto_dense", "bitcounter", "segmentcounter") and not self.args.cache:
+                print("--folds with a randomly generated source needs --cache, so that every fold sees the same cases")
+                quit()
+        return self.args.folds
+
+    def fold(self):
+        fold = self.args.fold if self.args.fold is not None else 0
+        print("held-out fold:", fold)
+        if self.folds_v and (fold < 0 or fold >= self.folds_v):
+            print("--fold must be between 0 and the number of folds - 1")
+            quit()
+        return fold
+
     def vint(self):
         print("validation intervals:", self.args.vint if self.args.vint is not None else 100)
         return self.args.vint if self.args.vint is not None else 100
 
+    def asyncval(self):
+        print("asynchronous validation:", self.args.asyncval)
+        return self.args.asyncval
+
+    def ckint(self):
+        print("checkpoint interval:", self.args.ckint)
+        return self.args.ckint
+
+    def ckkeep(self):
+        print("checkpoints to keep:", self.args.ckkeep if self.args.ckkeep is not None else 5)
+        return self.args.ckkeep if self.args.ckkeep is not None else 5
+
+    def keepsession(self):
+        print("keep session alive:", self.args.keepsession)
+        return self.args.keepsession
+
+    def intra(self):
+        print("intra-op threads:", self.args.intra if self.args.intra is not None else 0)
+        return self.args.intra if self.args.intra is not None else 0
+
+    def inter(self):
+        print("inter-op threads:", self.args.inter if self.args.inter is not None else 0)
+        return self.args.inter if self.args.inter is not None else 0
+
+    def affinity(self):
+        print("cpu affinity:", self.args.affinity if self.args.affinity is not None else "all cpus")
+        return self.args.affinity
+
+    def optlevel(self):
+        print("graph optimization level:", self.args.optlevel if self.args.optlevel is not None else "default")
+        if self.args.optlevel not in (None, 0, 1):
+            print("'", self.args.optlevel, "' is invalid for argument --optlevel", sep="")
+            print("Valid arguments are: 0, 1")
+            quit()
+        return self.args.optlevel
+
+    def xla(self):
+        print("xla jit compilation:", self.args.xla)
+        return self.args.xla
+
     def mbs(self):
         print("minibatch size:", self.args.mbs)
         return self.args.mbs
 
+    def replace(self):
+        print("sample with replacement:", self.args.replace)
+        return self.args.replace
+
+    def epoch(self):
+        print("epoch size:", self.args.epoch if self.args.epoch is not None else "all training cases")
+        return self.args.epoch
+
+    def pipeline(self):
+        print("use tf.data input pipeline:", self.args.pipeline)
+        return self.args.pipeline
+
+    def fused(self):
+        print("training steps per session call:", self.args.fused if self.args.fused is not None else 1)
+        return self.args.fused if self.args.fused is not None else 1
+
+    def towers(self):
+        towers = self.args.towers if self.args.towers is not None else 1
+        print("towers:", towers)
+        if towers < 1 or towers > self.mbs_v:
+            print("--towers must be between 1 and the minibatch size")
+            quit()
+        return towers
+
+    def ensemble(self):
+        ensemble = self.args.ensemble if self.args.ensemble is not None else 1
+        print("ensemble members:", ensemble)
+        if ensemble < 1:
+            print("--ensemble must be at least 1")
+            quit()
+        return ensemble
+
+    def bootstrap(self):
+        print("bootstrap minibatches:", self.args.bootstrap)
+        return self.args.bootstrap
+
+    def precision(self):
+        precision = self.args.precision if self.args.precision is not None else "float64"
+        print("network precision:", precision)
+        dict = {"float32": tf.float32, "float64": tf.float64}
+        if precision in dict:
+            return dict[precision]
+        else:
+            print("'", precision, "' is invalid for argument --precision", sep="")
+            print("Valid arguments are:", dict.keys())
+            quit()
+
+    def storage(self):
+        storage = self.args.storage if self.args.storage is not None else self.precision_v.name
+        print("case storage type:", storage)
+        dict = {"float16": numpy.float16, "float32": numpy.float32, "float64": numpy.float64}
+        if storage in dict:
+            return dict[storage]
+        else:
+            print("'", storage, "' is invalid for argument --storage", sep="")
+            print("Valid arguments are:", dict.keys())
+            quit()
+
     def steps(self):
         print("steps:", self.args.steps)
         return self.args.steps
@@ -286,6 +575,14 @@ class argument_parser():
         print("biases to be displayed:", self.args.dispb if self.args.dispb is not None else [])
         return self.args.dispb if self.args.dispb is not None else []
 
+    def probeint(self):
+        print("probe interval:", self.args.probeint if self.args.probeint is not None else 1)
+        return self.args.probeint if self.args.probeint is not None else 1
+
+    def probesample(self):
+        print("probe sample interval:", self.args.probesample)
+        return self.args.probesample
+
     def usevsi(self):
         print("use variance scaling for weights:", self.args.usevsi)
         return self.args.usevsi
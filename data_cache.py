@@ -0,0 +1,53 @@
+import os
+import json
+import hashlib
+import shutil
+import numpy
+
+# ******* DATA SET CACHE ********
+# The case arrays (features and targets) produced by argument_parser.source are written to .npy files, keyed by
+# the source, its sourceinit values and the storage type.  Later runs with the same key memory-map those files
+# instead of regenerating or re-parsing the data set, so startup is nearly free and concurrent runs (e.g. a sweep)
+# share the same pages of memory.  The cases are shuffled once, before they are written, so a cached data set is
+# already in random order and can be split without copying.  The cached cases are not normalized; that is done by
+# the case manager, which fits its normalizer to the training split.
+
+__cache_dir__ = "data_set_cache/"
+
+# For .txt sources, the size and modification time of the file are part of the key, so editing the file
+# invalidates its cache entry.  options holds any other settings that change the parsed arrays (e.g. the value that
+# replaces missing fields), so runs that parse the same file differently get different entries.
+def cache_key(source, sourceinit=None, dtype=numpy.float64, options=None, dir="data_set_files/"):
+    spec = [source, sourceinit, numpy.dtype(dtype).name, sorted((options or {}).items())]
+    if source[-4:] == ".txt" and os.path.exists(dir + source):
+        stat = os.stat(dir + source)
+        spec += [stat.st_size, stat.st_mtime]
+    digest = hashlib.sha1(json.dumps(spec).encode()).hexdigest()[0:16]
+    return source.replace('.', '_') + '-' + digest
+
+# Each entry is a directory holding the two arrays, so that both appear (or neither does) in one rename.
+def cache_paths(key, dir=__cache_dir__):
+    entry = os.path.join(dir, key)
+    return os.path.join(entry, 'features.npy'), os.path.join(entry, 'targets.npy')
+
+# Returns the (features, targets) pair of read-only memory-mapped arrays, or None when the key is not cached.
+def load_cases(key, dir=__cache_dir__):
+    fpath, tpath = cache_paths(key, dir)
+    if not os.path.isdir(os.path.join(dir, key)): return None
+    return numpy.load(fpath, mmap_mode='r'), numpy.load(tpath, mmap_mode='r')
+
+# Shuffle and write the case arrays.  Both files are written to a temporary directory, which is then renamed to the
+# entry's name, so a concurrent run never sees a half-written entry, nor one process's features next to another's
+# targets.  When two runs write the same entry at once, the first rename wins and the other run's files are dropped.
+def dump_cases(key, features, targets, dir=__cache_dir__):
+    os.makedirs(dir, exist_ok=True)
+    order = numpy.random.permutation(len(features))
+    tmp = os.path.join(dir, key + '.' + str(os.getpid()) + '.tmp')
+    os.makedirs(tmp, exist_ok=True)
+    for name, array in (('features.npy', features), ('targets.npy', targets)):
+        with open(os.path.join(tmp, name), 'wb') as f:
+            numpy.save(f, array[order])
+    try:
+        os.rename(tmp, os.path.join(dir, key))
+    except OSError:  # Another run has already put the entry in place
+        shutil.rmtree(tmp, ignore_errors=True)
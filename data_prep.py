@@ -0,0 +1,120 @@
+import os
+import itertools
+import multiprocessing
+import numpy
+
+# ******* NORMALIZATION ********
+# A Normalizer computes its statistics (per feature column) once, from one set of cases (normally the training
+# set), and then applies that same transformation to any other cases: validation, test and later inference data.
+# Modes: 'minmax' maps each column onto [0, 1], 'zscore' gives each column mean 0 and standard deviation 1.
+# Constant columns are only shifted (to 0) instead of being divided by zero.  The statistics are gathered over
+# blocks of (at most) chunk rows, so fitting a large (e.g. memory-mapped) array never makes a float copy of all of
+# it; with rows, only those rows of features are used, again without gathering them all at once.
+
+class Normalizer():
+    def __init__(self, mode='minmax', offset=None, scale=None):
+        if mode not in ('minmax', 'zscore'):
+            raise ValueError("normalization mode must be 'minmax' or 'zscore'")
+        self.mode = mode
+        self.offset = offset
+        self.scale = scale
+
+    def fit(self, features, rows=None, chunk=100000):
+        count = len(features) if rows is None else len(rows)
+        if count == 0:
+            raise ValueError("a normalizer can not be fitted to zero cases")
+        n, low, high, mean, m2 = 0, None, None, None, None
+        for start in range(0, count, chunk):
+            block = features[start:start + chunk] if rows is None else features[rows[start:start + chunk]]
+            block = numpy.asarray(block, dtype=numpy.float64)
+            if self.mode == 'minmax':
+                low = block.min(axis=0) if low is None else numpy.minimum(low, block.min(axis=0))
+                high = block.max(axis=0) if high is None else numpy.maximum(high, block.max(axis=0))
+            else:  # Merge the block's mean and sum of squared deviations into the running ones (Chan et al.)
+                nb, mb = len(block), block.mean(axis=0)
+                m2b = ((block - mb) ** 2).sum(axis=0)
+                if mean is None:
+                    mean, m2 = mb, m2b
+                else:
+                    delta = mb - mean
+                    mean = mean + delta * (nb / (n + nb))
+                    m2 = m2 + m2b + delta ** 2 * (n * nb / (n + nb))
+                n += nb
+        if self.mode == 'minmax':
+            self.offset, self.scale = low, high - low
+        else:
+            self.offset, self.scale = mean, numpy.sqrt(m2 / n)
+        self.scale[self.scale == 0] = 1
+        return self
+
+    # Returns a new array of the same (float) type as features.
+    def transform(self, features):
+        dtype = features.dtype if numpy.issubdtype(features.dtype, numpy.floating) else numpy.float64
+        return ((features - self.offset) / self.scale).astype(dtype)
+
+    def fit_transform(self, features):
+        return self.fit(features).transform(features)
+
+    def save(self, path):
+        numpy.savez(path, mode=self.mode, offset=self.offset, scale=self.scale)
+
+def load_normalizer(path):
+    saved = numpy.load(path)
+    return Normalizer(str(saved['mode']), offset=saved['offset'], scale=saved['scale'])
+
+# ******* DELIMITED TEXT FILES ********
+# The data_set_files hold one case per line, with ';' or ',' between the fields and '?' for missing values.  Rather
+# than splitting lines and converting fields one at a time in Python, a block of lines is turned into a single
+# comma-separated string and parsed by numpy in one call.
+
+def parse_delimited_text(text, missing=0.0):
+    text = text.replace(';', ',').replace('?', repr(float(missing)))
+    lines = [l for l in text.splitlines() if l.strip()]
+    if not lines: return numpy.zeros((0, 0))
+    columns = lines[0].count(',') + 1
+    values = numpy.fromstring(','.join(lines), dtype=numpy.float64, sep=',')
+    if len(values) != len(lines) * columns:
+        raise ValueError("rows of the delimited text do not all have " + str(columns) + " fields")
+    return values.reshape(len(lines), columns)
+
+# Parse an open text file in blocks of (at most) chunk lines, yielding one 2-d array per block.
+def read_delimited_chunks(file, chunk=100000, missing=0.0):
+    while True:
+        lines = list(itertools.islice(file, chunk))
+        if not lines: return
+        data = parse_delimited_text(''.join(lines), missing=missing)
+        if len(data) > 0: yield data
+
+# Split a file into (about) parts byte ranges that each start at the beginning of a line.
+def line_aligned_ranges(path, parts):
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as file:
+        for i in range(1, parts):
+            file.seek(max(bounds[-1], size * i // parts))
+            file.readline()  # Move on to the start of the next line
+            bounds.append(min(file.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+def parse_byte_range(path, start, end, missing=0.0):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        return parse_delimited_text(file.read(end - start).decode(), missing=missing)
+
+# Load a whole delimited file into one 2-d float array.  With processes > 1, the file is cut into line-aligned byte
+# ranges that are parsed by a pool of worker processes.
+def load_delimited(path, missing=0.0, chunk=100000, processes=1):
+    if processes > 1:
+        ranges = [(path, start, end, missing) for start, end in line_aligned_ranges(path, processes)]
+        with multiprocessing.Pool(processes) as pool:
+            blocks = pool.starmap(parse_byte_range, ranges)
+    else:
+        with open(path) as file:
+            blocks = list(read_delimited_chunks(file, chunk=chunk, missing=missing))
+    blocks = [b for b in blocks if len(b) > 0]
+    return numpy.concatenate(blocks) if blocks else numpy.zeros((0, 0))
+
+# The last column holds a 1-based class label, which becomes a 0-based class index.
+def split_labels(data):
+    return data[:, :-1], data[:, -1].astype(int) - 1
@@ -2,16 +2,25 @@ import tensorflow as tf
 import numpy as np
 import math
 import random
+import os
+import threading
+import queue
+import multiprocessing
 import matplotlib.pyplot as PLT
 import tflowtools as TFT
+import data_prep
 
 # ******* A General Artificial Neural Network ********
 # This is the original GANN, which has been improved in the file gann.py
 
 class Gann():
-    def __init__(self, dims, cman, afunc, ofunc, cfunc, optimizer, lrate, wrange, vint, mbs, usevsi, showint=None):
+    def __init__(self, dims, cman, afunc, ofunc, cfunc, optimizer, lrate, wrange, vint, mbs, usevsi, showint=None,
+                replace=False, epoch=None, pipeline=False, fused=1, precision=tf.float64,
+                asyncval=False, ckint=None, ckkeep=5, keepsession=False, viewdir='probeview',
+                savepath='netsaver/my_saved_session', towers=1, ensemble=1, bootstrap=False):
         self.layer_sizes = dims  # Sizes of each layer of neurons
         self.caseman = cman
+        self.normalizer = cman.normalizer  # Stored with the checkpoints, for transforming later inference data
         self.activation_func = afunc
         self.activation_outputs = ofunc
         self.loss_function = cfunc
@@ -20,18 +29,51 @@ class Gann():
         self.weight_range = wrange
         self.show_interval = showint  # Frequency of showing grabbed variables
         self.minibatch_size = mbs
+        self.replace = replace  # Sample minibatches with replacement (True) or by walking through epochs (False)
+        self.epoch_size = epoch  # Number of training cases per epoch (None = all of them)
+        self.sampler = None  # Created on the first training session and kept for runmore (except a Gensampler)
+        self.use_pipeline = pipeline  # Feed cases through a prefetching tf.data pipeline instead of feed_dicts
+        self.fused_steps = fused  # Number of training steps run inside the graph per call to sess.run
+        self.towers = towers  # Number of network replicas that share each training minibatch (see gen_gradients)
+        if towers > mbs:
+            raise ValueError("a minibatch of " + str(mbs) + " cases can not be split across " + str(towers) + " towers")
+        self.ensemble = ensemble  # Number of independent networks trained side by side (see build)
+        self.bootstrap = bootstrap  # Train each ensemble member on its own resample of every minibatch
+        self.member_test_results = None  # The members' results of the latest test, in an ensemble
+        self.view_member = 0  # The ensemble member that grabvars, probes and mapping show (see Gannmodule.getvar)
+        self.dtype = precision  # Float type of placeholders, weights, biases and losses (tf.float32 or tf.float64)
         self.validation_interval = vint
         self.usevsi = usevsi
         self.global_training_step = 0  # Enables coherent data-storage during extra training runs (see runmore).
         self.grabvars = []  # Variables to be monitored (by gann code) during a run.
         self.grabvar_figures = []  # One matplotlib figure for each grabvar
         self.validation_history = []
+        self.async_validation = asyncval  # Run validation tests on a background thread, on snapshots of the weights
+        self.validator = None  # The Snapshotworker that does the asynchronous validation testing
+        self.checkpoint_interval = ckint  # Training steps between periodic checkpoints (None = no checkpoints)
+        self.checkpoint_keep = ckkeep  # Number of periodic checkpoints kept on disk
+        self.keep_session = keepsession  # Keep the session (and all variables) alive between run, runmore and mapping
+        self.viewdir = viewdir  # Directory of the tensorboard logs
+        self.save_path = savepath  # Path prefix of the checkpoints
+        self.session_closed = False
         self.modules = []
+        self.probes = {}  # interval => merged summary op of all probes with that interval
+        self.probe_counts = {}  # interval => number of summaries in that merged op
+        self.reservoirs = []  # Probereservoirs of histogram probes that are sampled between writes
         self.build()
 
-    # Probed variables are to be displayed in the Tensorboard.
-    def gen_probe(self, module_index, type, spec):
-        self.modules[module_index].gen_probe(type, spec)
+    # Probed variables are to be displayed in the Tensorboard.  A probe is only computed and written on steps that are
+    # a multiple of its interval.  When sample is given, a histogram probe instead fetches its variable every sample
+    # steps into a reservoir, and writes a histogram of the reservoir every interval steps.
+    def gen_probe(self, module_index, type, spec, interval=1, sample=None):
+        self.modules[module_index].gen_probe(type, spec, interval=interval, sample=sample)
+
+    # The summaries of the probes for each interval are kept in a graph collection of their own.
+    def probe_collection(self, interval):
+        self.probe_counts.setdefault(interval, 0)
+        return 'probes-' + str(interval)
+
+    def add_reservoir(self, reservoir): self.reservoirs.append(reservoir)
 
     # Grabvars are displayed by my own code, so I have more control over the display format.
     # Each grabvar gets its own matplotlib figure in which to display its value.
@@ -44,16 +86,48 @@ class Gann():
         self.grabvars = []
         self.grabvar_figures = []
 
+    # Merge the summaries of each interval, re-merging only those intervals that gained probes since the last call.
     def roundup_probes(self):
-        self.probes = tf.summary.merge_all()
+        for interval, count in self.probe_counts.items():
+            summaries = tf.get_collection(self.probe_collection(interval))
+            if len(summaries) != count:
+                self.probes[interval] = tf.summary.merge(summaries)
+                self.probe_counts[interval] = len(summaries)
+
+    # The merged probe summaries whose interval divides step, and the reservoirs that take a sample at step.
+    def due_probes(self, probed_vars, step):
+        if probed_vars is None: return [], []
+        summaries = [op for interval, op in probed_vars.items() if step % interval == 0]
+        reservoirs = [r for r in self.reservoirs if step % r.sample_interval == 0]
+        return summaries, reservoirs
+
+    def write_probes(self, sess, summaries, reservoirs, sampled_vals, step):
+        for summary in summaries:
+            sess.probe_stream.add_summary(summary, global_step=step)
+        for reservoir, vals in zip(reservoirs, sampled_vals):
+            reservoir.add(vals)
+
+    # Write the histogram of each reservoir whose interval divides step.  This is done on every training step (after
+    # that step's probes), whether or not any probe was due, so no interval is skipped.
+    def flush_reservoirs(self, sess, step):
+        for reservoir in self.reservoirs:
+            if step % reservoir.interval == 0 and reservoir.filled > 0:
+                sess.probe_stream.add_summary(reservoir.gen_summary(), global_step=step)
 
     def add_module(self, module): self.modules.append(module)
 
     def build(self):
         tf.reset_default_graph()  # This is essential for doing multiple runs!!
         num_inputs = self.layer_sizes[0]
-        self.input = tf.placeholder(tf.float64, shape=(None, num_inputs), name='Input')
-        invar = self.input
+        num_outputs = self.layer_sizes[-1]
+        if self.use_pipeline:
+            # Input and target default to the pipeline's batches, but can still be fed (e.g. when mapping).
+            self.pipeline = Gannpipeline(num_inputs, num_outputs, dtype=self.dtype)
+            self.input = tf.placeholder_with_default(self.pipeline.input, shape=(None, num_inputs), name='Input')
+        else:
+            self.pipeline = None
+            self.input = tf.placeholder(self.dtype, shape=(None, num_inputs), name='Input')
+        invar = self.gen_member_inputs(self.input)
         insize = num_inputs
         # Build all of the modules
         for i, outsize in enumerate(self.layer_sizes[1:]):
@@ -63,8 +137,16 @@ class Gann():
         self.output = gmod.output  # Output of last module is output of whole network
         if self.activation_outputs:
             self.output = self.activation_outputs(self.output)
-        self.target = tf.placeholder(tf.float64, shape=(None, gmod.outsize), name='Target')
+        if self.ensemble > 1:
+            self.member_outputs = self.output
+            self.output = tf.reduce_mean(self.member_outputs, axis=0, name='Ensemble-output')
+        if self.pipeline:
+            self.target = tf.placeholder_with_default(self.pipeline.target, shape=(None, num_outputs), name='Target')
+        else:
+            self.target = tf.placeholder(self.dtype, shape=(None, gmod.outsize), name='Target')
         self.configure_learning()
+        self.checkpointer = Checkpointer(self, spath=self.save_path, keep=self.checkpoint_keep)
+        self.state_saver = self.checkpointer.saver
 
     # The optimizer knows to gather up all "trainable" variables in the function graph and compute
     # derivatives of the error function with respect to each component of each variable, i.e. each weight
@@ -73,62 +155,238 @@ class Gann():
         # self.error = tf.reduce_mean(tf.square(self.target - self.output), name='MSE')
         self.error = self.loss_function(self.target, self.output)
         self.predictor = self.output  # Simple prediction runs will request the value of output neurons
+        # Evaluation ops are built once, here, so that testing never adds nodes to the graph.  The labels (class
+        # indices) default to the argmax of the one-hot targets, but can also be fed directly.
+        self.labels = tf.placeholder_with_default(tf.argmax(self.target, axis=1, output_type=tf.int32), shape=(None,),
+                    name='Labels')
+        self.match_counters = {}  # bestk => match-counting op
+        self.get_match_counter(1)
+        if self.ensemble > 1:
+            self.member_errors = tf.stack([self.loss_function(self.target, self.member_outputs[m])
+                                           for m in range(self.ensemble)], name='Member-errors')
+            self.member_match_counters = {}
         # Defining the training operator
         optimizer = self.optimizer_class(self.learning_rate)
-        self.trainer = optimizer.minimize(self.error, name='Backprop')
+        objective = self.error if self.ensemble == 1 else None
+        self.training_error, gradients = self.gen_gradients(optimizer, self.input, self.target, objective)
+        self.trainer = optimizer.apply_gradients(gradients, name='Backprop')
+        if self.fused_steps > 1:
+            self.gen_fused_trainer(optimizer)
+
+    # The error of a minibatch and the gradients of that error.  With one tower, this is what optimizer.minimize
+    # does for the given error.  With more towers, the minibatch is split into towers (nearly) equal shards, and
+    # each shard runs through its own replica of the network (see gen_forward), so the towers' independent ops can
+    # run in parallel on TensorFlow's inter-op threads.  Since each loss is a mean over its shard, the minibatch's
+    # error and gradients are the averages of the towers' ones, weighted by shard size: the same values (up to
+    # rounding) as with a single tower.  In an ensemble, the returned error is the mean of the members' errors.
+    def gen_gradients(self, optimizer, inputs, targets, error=None):
+        params = tf.trainable_variables()
+        if self.towers == 1:
+            error = error if error is not None else self.gen_objective(inputs, targets)
+            return self.member_mean(error), optimizer.compute_gradients(error, var_list=params)
+        num_cases = tf.shape(inputs)[0]
+        sizes = num_cases // self.towers + tf.cast(tf.range(self.towers) < num_cases % self.towers, tf.int32)
+        weights = tf.cast(sizes, self.dtype) / tf.cast(num_cases, self.dtype)
+        input_shards = tf.split(inputs, sizes, num=self.towers, name='Tower-inputs')
+        target_shards = tf.split(targets, sizes, num=self.towers, name='Tower-targets')
+        errors, tower_gradients = [], []
+        for k in range(self.towers):
+            with tf.name_scope('Tower-' + str(k)):
+                tower_error = self.gen_objective(input_shards[k], target_shards[k])
+                errors.append(weights[k] * tower_error)
+                tower_gradients.append([weights[k] * g for g, _ in optimizer.compute_gradients(tower_error, params)])
+        gradients = [(tf.add_n(list(gs)), v) for gs, v in zip(zip(*tower_gradients), params)]
+        return self.member_mean(tf.add_n(errors, name='Tower-error')), gradients
+
+    # What training minimizes for a minibatch: the error of the network or, in an ensemble, the sum of the members'
+    # errors, so that each member (whose weights no other member's error depends on) gets exactly the gradients it
+    # would get if it were trained alone.  The members' cases are stacked into one batch for the loss, whose mean
+    # over all members' cases is then the mean of their (equal-sized) errors.
+    def gen_objective(self, inputs, targets):
+        if self.ensemble == 1:
+            return self.loss_function(targets, self.gen_forward(inputs))
+        inputs, targets = self.gen_member_cases(inputs, targets)
+        outputs = self.gen_forward(inputs)
+        num_outputs = self.layer_sizes[-1]
+        error = self.loss_function(tf.reshape(targets, (-1, num_outputs)), tf.reshape(outputs, (-1, num_outputs)))
+        return self.ensemble * error
 
-    def do_training(self, sess, cases, steps, continued=False):
+    # Names the member that grabvars, probes and mapping show, for the titles of their displays.
+    def view_label(self):
+        return '' if self.ensemble == 1 else ' (ensemble member %d of %d)' % (self.view_member, self.ensemble)
+
+    def member_mean(self, error):
+        return error / self.ensemble if self.ensemble > 1 else error
+
+    # In an ensemble, the input of the network has a leading member axis, and every layer does one batched matmul
+    # over that axis.  Without bootstrap, every member gets the same cases; with bootstrap, each member gets its own
+    # resample (with replacement) of the minibatch.
+    def gen_member_inputs(self, inputs):
+        if self.ensemble == 1: return inputs
+        return tf.tile(tf.expand_dims(inputs, 0), [self.ensemble, 1, 1])
+
+    def gen_member_cases(self, inputs, targets):
+        if not self.bootstrap:
+            return self.gen_member_inputs(inputs), self.gen_member_inputs(targets)
+        num_cases = tf.shape(inputs)[0]
+        indices = tf.random_uniform((self.ensemble, num_cases), 0, num_cases, dtype=tf.int32)
+        return tf.gather(inputs, indices), tf.gather(targets, indices)
+
+    # Run an input tensor through the existing modules (i.e. with the same weights and biases) a second time.  In an
+    # ensemble, an input without the member axis goes to every member, and the members' outputs are returned.
+    def gen_forward(self, invar):
+        if invar.shape.ndims == 2:
+            invar = self.gen_member_inputs(invar)
+        for gmod in self.modules:
+            invar = gmod.apply(invar)
+        return self.activation_outputs(invar) if self.activation_outputs else invar
+
+    # The fused trainer runs up to fused_steps optimizer steps inside a single sess.run and returns the error of
+    # each step.  The training cases are loaded once per session into two non-trainable variables, and each pass
+    # through the while-loop draws a minibatch from them (uniformly, with replacement), runs it through the network
+    # (split across the towers, if any) and applies one update.  The trainer (above) has already created the
+    # optimizer's slots (e.g. Adam's moments), so apply_gradients inside the loop reuses them rather than creating
+    # variables inside control flow.
+    def gen_fused_trainer(self, optimizer):
+        num_inputs, num_outputs = self.layer_sizes[0], self.layer_sizes[-1]
+        self.fused_features = tf.placeholder(self.dtype, shape=(None, num_inputs), name='Fused-features')
+        self.fused_targets = tf.placeholder(self.dtype, shape=(None, num_outputs), name='Fused-targets')
+        feature_store = tf.Variable(self.fused_features, trainable=False, collections=[], validate_shape=False,
+                                    name='Fused-feature-store')
+        target_store = tf.Variable(self.fused_targets, trainable=False, collections=[], validate_shape=False,
+                                   name='Fused-target-store')
+        self.fused_loader = tf.group(feature_store.initializer, target_store.initializer)
+        self.fused_session = None  # The session into which the training cases were last loaded
+        self.fused_count = tf.placeholder(tf.int32, shape=(), name='Fused-steps')
+        num_cases = tf.shape(feature_store)[0]
+
+        def body(i, errors):
+            with tf.control_dependencies([i]):  # i is only produced once the previous update is done
+                indices = tf.random_uniform([self.minibatch_size], 0, num_cases, dtype=tf.int32)
+                inputs = tf.gather(feature_store, indices)
+                targets = tf.gather(target_store, indices)
+                inputs.set_shape((None, num_inputs))
+                targets.set_shape((None, num_outputs))
+                error, gradients = self.gen_gradients(optimizer, inputs, targets)
+                update = optimizer.apply_gradients(gradients)
+            with tf.control_dependencies([update]):
+                return i + 1, errors.write(i, error)
+
+        errors = tf.TensorArray(self.dtype, size=self.fused_count)
+        _, errors = tf.while_loop(lambda i, errors: i < self.fused_count, body, (tf.constant(0), errors),
+                                  parallel_iterations=1, name='Fused-backprop')
+        self.fused_trainer = errors.stack()
+
+    def do_training(self, sess, sampler, steps, continued=False):
         if not(continued): self.error_history = []
-        for i in range(steps):
-            error = 0
-            step = self.global_training_step + i
-            gvars = [self.error] + self.grabvars
-            mbs = self.minibatch_size
-            minibatch = random.sample(list(cases), mbs)  # randomly selected of size mbs
-            inputs = [c[0] for c in minibatch]
-            targets = [c[1] for c in minibatch]
-            feeder = {self.input: inputs, self.target: targets}
-            _, grabvals, _ = self.run_one_step([self.trainer], gvars, self.probes, session=sess,
-                        feed_dict=feeder, step=step, show_interval=self.show_interval)
-            error += grabvals[0]
-            self.error_history.append((step, error))
-            self.consider_validation_testing(step, sess)
+        if self.fused_steps > 1:
+            self.do_fused_training(sess, sampler, steps)
+        else:
+            for i in range(steps):
+                error = 0
+                step = self.global_training_step + i
+                gvars = [self.training_error] + self.grabvars
+                if self.pipeline:  # The next minibatch is already waiting in the pipeline's prefetch buffer
+                    if not self.pipeline.running(sess):
+                        features, targets = sampler.get_cases()
+                        self.pipeline.start(sess, 'training', features, targets, self.minibatch_size)
+                    feeder = None
+                else:
+                    inputs, targets = sampler.next_batch()  # cost depends only on the minibatch size
+                    feeder = {self.input: inputs, self.target: targets}
+                _, grabvals, _ = self.run_one_step([self.trainer], gvars, self.probes, session=sess,
+                            feed_dict=feeder, step=step, show_interval=self.show_interval)
+                self.flush_reservoirs(sess, step)
+                error += grabvals[0]
+                self.error_history.append((step, error))
+                self.consider_validation_testing(step, sess)
+                self.consider_checkpointing(step, sess)
         self.global_training_step += steps
+        if self.validator:  # Wait for outstanding validation tests, which may have finished out of step order
+            self.validator.wait()
+            self.validation_history.sort(key=(lambda p: p[0]))
+        # In an ensemble, the training error is the mean of the members' errors, the validation error that of the
+        # ensemble's (averaged) output.
+        labels = ['Training (mean of the members)', 'Validation (ensemble output)'] if self.ensemble > 1 else None
         TFT.plot_training_history(self.error_history, self.validation_history,
-                    xtitle="Step", ytitle="Error", title="", fig=not(continued))
+                    xtitle="Step", ytitle="Error", title="", fig=not(continued), labels=labels)
+
+    # Each call to the fused trainer stops at the next step that needs validation testing or the display of grabvars,
+    # so error_history, validation_history and the grabvar displays keep the same per-step meaning as in do_training.
+    # Grabvars and probes are read in a separate run after the fused steps, on a fresh minibatch.
+    def do_fused_training(self, sess, sampler, steps):
+        if self.fused_session is not sess:
+            features, targets = sampler.get_cases()
+            feeder = {self.fused_features: features, self.fused_targets: targets}
+            sess.run(self.fused_loader, feed_dict=feeder)
+            self.fused_session = sess
+        i = 0
+        while i < steps:
+            step = self.global_training_step + i
+            k = min(self.fused_steps, steps - i, self.steps_to_checkpoint(step))
+            errors = sess.run(self.fused_trainer, feed_dict={self.fused_count: k})
+            for j, error in enumerate(errors):
+                self.error_history.append((step + j, error))
+            last = step + k - 1
+            if any(self.due_probes(self.probes, last)) or (self.show_interval and last % self.show_interval == 0):
+                inputs, targets = sampler.next_batch()
+                feeder = {self.input: inputs, self.target: targets}
+                self.run_one_step([], self.grabvars, self.probes, session=sess, feed_dict=feeder, step=last,
+                        show_interval=self.show_interval)
+            self.flush_reservoirs(sess, last)
+            self.consider_validation_testing(last, sess)
+            self.consider_checkpointing(last, sess)
+            i += k
+
+    # Number of steps, starting with this one, up to and including the next step at which validation testing is done,
+    # grabvars are displayed, probes are collected or written, or a checkpoint is written.  Checkpoints are due one
+    # step earlier than the others (see consider_checkpointing), when step + 1 is a multiple of their interval.
+    def steps_to_checkpoint(self, step):
+        intervals = [self.validation_interval, self.show_interval] + list(self.probes.keys())
+        intervals += [r.sample_interval for r in self.reservoirs] + [r.interval for r in self.reservoirs]
+        steps = [(-step) % iv + 1 for iv in intervals if iv]
+        if self.checkpoint_interval:
+            steps.append((-(step + 1)) % self.checkpoint_interval + 1)
+        return min(steps + [self.fused_steps])
 
     # bestk = 1 when you're doing a classification task and the targets are one-hot vectors.
     # This will invoke the gen_match_counter error function.
     # Otherwise, when bestk=None, the standard MSE error function is used for testing.
 
     def do_testing(self, sess, cases, msg='Testing', bestk=None):
-        inputs = [c[0] for c in cases]
-        targets = [c[1] for c in cases]
+        inputs, targets = cases
         feeder = {self.input: inputs, self.target: targets}
-        self.test_func = self.error
-        if bestk is not None:
-            self.test_func = self.gen_match_counter(self.predictor, [TFT.one_hot_to_int(list(v)) for v in targets], k=bestk)
-        testres, grabvals, _ = self.run_one_step(self.test_func, self.grabvars, self.probes,
+        if self.pipeline:  # Run the whole set through the pipeline's evaluation iterator as one batch
+            feeder = self.pipeline.start(sess, msg, inputs, targets, len(inputs))
+        self.test_func = self.error if bestk is None else self.get_match_counter(bestk)
+        if self.ensemble > 1:  # Also test the members on their own
+            self.test_func = [self.test_func, self.get_member_tests(bestk)]
+        # No probes: they belong to training steps, and a test has no step of its own.
+        testres, grabvals, _ = self.run_one_step(self.test_func, self.grabvars, None,
                     session=sess, feed_dict=feeder, show_interval=None)
+        if self.ensemble > 1:
+            testres, self.member_test_results = testres
+            for m, res in enumerate(self.member_test_results):
+                if bestk is None:
+                    print('%s Set Error of member %d = %f ' % (msg, m, res))
+                else:
+                    print('%s Set Correct Classifications of member %d = %f %%' % (msg, m, 100*(res/len(inputs))))
         if bestk is None:
             print('%s Set Error = %f ' % (msg, testres))
         else:
-            print('%s Set Correct Classifications = %f %%' % (msg, 100*(testres/len(cases))))
+            print('%s Set Correct Classifications = %f %%' % (msg, 100*(testres/len(inputs))))
         return testres  # self.error uses MSE, so this is a per-case value when bestk=None
 
-    def do_mapping(self):
+    # Run the mapping cases through the network in chunks of (at most) chunk cases and return one matrix per grabvar
+    # (rows = cases, columns = the grabbed layer's neurons), along with the target vectors of the mapping cases.
+    def do_mapping(self, chunk=1000):
         self.reopen_current_session()
         sess = self.current_session
-        cases = self.caseman.get_mapping_cases()
-        results = []
-        labels = []
-        for i, case in enumerate(cases):
-            feeder = {self.input: [case[0]], self.target: [case[1]]}
-            self.test_func = self.error
-            _, grabvals, _ = self.run_one_step(self.test_func, self.grabvars, self.probes,
-                    session=sess, feed_dict=feeder, show_interval=None, display_vars=False)
-            results.append(grabvals)
-            labels.append(case[1])
+        inputs, labels = self.caseman.get_mapping_cases()
+        chunks = []
+        for start in range(0, len(inputs), chunk):
+            chunks.append(sess.run(self.grabvars, feed_dict={self.input: inputs[start:start + chunk]}))
+        results = [np.concatenate([c[i] for c in chunks]) for i in range(len(self.grabvars))] if chunks else []
         self.close_current_session(view=False)
         return results, labels
 
@@ -148,35 +406,75 @@ class Gann():
         # correct = tf.equal(indices1, indices2)
         return tf.reduce_sum(tf.cast(correct, tf.int32))
 
-    def training_session(self, steps, sess=None, dir="probeview", continued=False):
-        session = sess if sess else TFT.gen_initialized_session(dir=dir)
+    # Match counters are cached, so each value of k adds its ops to the graph only once.
+    def get_match_counter(self, k=1):
+        if k not in self.match_counters:
+            self.match_counters[k] = self.gen_match_counter(self.predictor, self.labels, k=k)
+        return self.match_counters[k]
+
+    # The errors (bestk=None) or match counts of the separate members of an ensemble.
+    def get_member_tests(self, bestk=None):
+        if bestk is None: return self.member_errors
+        if bestk not in self.member_match_counters:
+            self.member_match_counters[bestk] = tf.stack([self.gen_match_counter(self.member_outputs[m], self.labels,
+                                                          k=bestk) for m in range(self.ensemble)])
+        return self.member_match_counters[bestk]
+
+    def training_session(self, steps, sess=None, dir=None, continued=False):
+        session = sess if sess else TFT.gen_initialized_session(dir=dir if dir else self.viewdir)
         self.current_session = session
+        self.session_closed = False
         self.roundup_probes()  # this call must come AFTER the session is created, else graph is not in tensorboard.
-        self.do_training(session, self.caseman.get_training_cases(), steps, continued=continued)
+        if self.sampler is None:
+            self.sampler = self.caseman.gen_sampler(self.minibatch_size, replace=self.replace, epoch=self.epoch_size)
+        if self.sampler.features is None and (self.pipeline or self.fused_steps > 1):
+            raise ValueError("the input pipeline and the fused trainer need a case manager that holds its cases")
+        self.do_training(session, self.sampler, steps, continued=continued)
 
     def testing_session(self, sess, bestk=None):
         cases = self.caseman.get_testing_cases()
-        if len(cases) > 0:
-            self.do_testing(sess, cases, msg='Final Testing', bestk=bestk)
+        if len(cases[0]) > 0:
+            return self.do_testing(sess, cases, msg='Final Testing', bestk=bestk)
 
     def consider_validation_testing(self, step, sess):
         if self.validation_interval and (step % self.validation_interval == 0):
             cases = self.caseman.get_validation_cases()
-            if len(cases) > 0:
-                error = self.do_testing(sess, cases, msg='Validation Testing')
-                self.validation_history.append((step, error))
+            if len(cases[0]) > 0:
+                if self.async_validation:
+                    if self.validator is None:
+                        self.validator = Snapshotworker(self)
+                    self.validator.submit(self.do_snapshot_validation, self.gen_snapshot(sess), step, cases)
+                else:
+                    error = self.do_testing(sess, cases, msg='Validation Testing')
+                    self.validation_history.append((step, error))
+                    self.checkpointer.consider_best(sess, step + 1, error)
+
+    # Validation testing of a snapshot of the network, run by the validator's thread in the validator's own session.
+    # Feeding the cases directly keeps the validator away from the input pipeline used by the training loop.
+    def do_snapshot_validation(self, sess, step, cases):
+        inputs, targets = cases
+        error = sess.run(self.error, feed_dict={self.input: inputs, self.target: targets})
+        print('Validation Testing (step %d) Set Error = %f ' % (step, error))
+        self.validation_history.append((step, error))
+        self.checkpointer.consider_best(sess, step + 1, error)
+
+    # Periodic checkpoints are numbered by the number of training steps done, hence step + 1.
+    def consider_checkpointing(self, step, sess):
+        if self.checkpoint_interval and ((step + 1) % self.checkpoint_interval == 0):
+            self.checkpointer.save(self.gen_snapshot(sess), step + 1)
 
     # Do testing (i.e. calc error without learning) on the training set.
     def test_on_trains(self, sess, bestk=None):
-        self.do_testing(sess, self.caseman.get_training_cases(), msg='Total Training', bestk=bestk)
+        return self.do_testing(sess, self.caseman.get_training_cases(), msg='Total Training', bestk=bestk)
 
     # Similar to the "quickrun" functions used earlier.
     def run_one_step(self, operators, grabbed_vars=None, probed_vars=None, dir='probeview',
                     session=None, feed_dict=None, step=1, show_interval=1, display_vars=True):
         sess = session if session else TFT.gen_initialized_session(dir=dir)
-        if probed_vars is not None:
-            results = sess.run([operators, grabbed_vars, probed_vars], feed_dict=feed_dict)
-            sess.probe_stream.add_summary(results[2], global_step=step)
+        summaries, reservoirs = self.due_probes(probed_vars, step)
+        if summaries or reservoirs:  # Probes cost nothing on steps where none of them is due
+            results = sess.run([operators, grabbed_vars, summaries, [r.var for r in reservoirs]], feed_dict=feed_dict)
+            self.write_probes(sess, results[2], reservoirs, results[3], step)
         else:
             results = sess.run([operators, grabbed_vars], feed_dict=feed_dict)
         if show_interval and (step % show_interval == 0) and display_vars:
@@ -196,13 +494,15 @@ class Gann():
             else:
                 print(v, end="\n\n")
 
+    # Returns the results of the tests on the training and the testing cases (None when there are no testing cases).
     def run(self, steps=100, sess=None, continued=False, bestk=None):
         PLT.ion()
         self.training_session(steps, sess=sess, continued=continued)
-        self.test_on_trains(sess=self.current_session, bestk=bestk)
-        self.testing_session(sess=self.current_session, bestk=bestk)
+        training = self.test_on_trains(sess=self.current_session, bestk=bestk)
+        testing = self.testing_session(sess=self.current_session, bestk=bestk)
         self.close_current_session(view=False)
         PLT.ioff()
+        return training, testing
 
     # After a run is complete, runmore allows us to do additional training on the network, picking up where we
     # left off after the last call to run (or runmore).  Use of the "continued" parameter (along with
@@ -210,7 +510,7 @@ class Gann():
 
     def runmore(self, steps=100, bestk=None):
         self.reopen_current_session()
-        self.run(steps, sess=self.current_session, continued=True, bestk=bestk)
+        return self.run(steps, sess=self.current_session, continued=True, bestk=bestk)
 
     #   ******* Saving GANN Parameters (weights and biases) *******************
     # This is useful when you want to use "runmore" to do additional training on a network.
@@ -230,28 +530,67 @@ class Gann():
             with self.function_graph.as_default():
                  self.state_saver = tf.train.Saver()
 
-    def save_session_params(self, spath='netsaver/my_saved_session', sess=None, step=0):
-        session = sess if sess else self.current_session
+    # The weight and bias Variables themselves (in an ensemble, those of all members), not the member views of getvar.
+    def get_state_vars(self):
         state_vars = []
         for m in self.modules:
-            vars = [m.getvar('wgt'), m.getvar('bias')]
+            vars = [m.weights, m.biases]
             state_vars = state_vars + vars
-        self.state_saver = tf.train.Saver(state_vars)
-        self.saved_state_path = self.state_saver.save(session, spath, global_step=step)
+        return state_vars
+
+    # A snapshot is a list of the current values (numpy arrays) of the state vars: the weights and biases.
+    def gen_snapshot(self, sess):
+        return sess.run(self.get_state_vars())
+
+    def load_snapshot(self, sess, snapshot):
+        for var, value in zip(self.get_state_vars(), snapshot):
+            var.load(value, sess)
+
+    def save_session_params(self, spath='netsaver/my_saved_session', sess=None, step=0):
+        session = sess if sess else self.current_session
+        self.saved_state_path = self.state_saver.save(session, spath, global_step=step, write_meta_graph=False)
 
+    # With keep_session, the current session was never closed, so the weights, biases and optimizer slots (e.g. Adam's
+    # moments) are all still there and training picks up exactly where it stopped.
     def reopen_current_session(self):
+        if self.keep_session and not self.session_closed: return
         self.current_session = TFT.copy_session(self.current_session)  # Open a new session with same tensorboard stuff
         self.current_session.run(tf.global_variables_initializer())
+        self.saved_state_path = self.checkpointer.latest()  # Waits for the checkpoint written by close_current_session
         self.restore_session_params()  # Reload old weights and biases to continued from where we last left off
 
     def restore_session_params(self, path=None, sess=None):
         spath = path if path else self.saved_state_path
         session = sess if sess else self.current_session
-        self.state_saver.restore(session, spath)
+        state_vars = self.get_state_vars()
+        reader = tf.train.NewCheckpointReader(spath)
+        saved_types = reader.get_variable_to_dtype_map()
+        if all(saved_types.get(v.op.name) == v.dtype.base_dtype for v in state_vars):
+            self.state_saver.restore(session, spath)
+        else:  # The parameters were saved at another precision, so convert each of them on the way in.
+            for v in state_vars:
+                v.load(reader.get_tensor(v.op.name).astype(v.dtype.base_dtype.as_numpy_dtype), session)
 
-    def close_current_session(self,view=True):
-        self.save_session_params(sess=self.current_session)
-        TFT.close_session(self.current_session, view=view)
+    # The checkpoint is written in the background, from a snapshot taken before the session closes.  With keep_session,
+    # the session is only really closed when final=True; otherwise the probes are just flushed to disk.  The validator
+    # and the checkpointer's worker (threads and sessions) are closed along with the session, after the checkpointer
+    # has written everything; a later runmore starts new ones.
+    def close_current_session(self,view=True,final=False):
+        if self.keep_session and not final:
+            self.current_session.probe_stream.flush()
+            return
+        try:  # A failed validation test or checkpoint write is raised here, but only once everything is closed
+            if self.validator:  # Closing waits for the outstanding validation tests
+                validator, self.validator = self.validator, None
+                validator.close()
+        finally:
+            self.checkpointer.save(self.gen_snapshot(self.current_session), self.global_training_step)
+            TFT.close_session(self.current_session, view=view)
+            if isinstance(self.sampler, Gensampler):  # Stop its producer; runmore starts a new one
+                self.sampler.close()
+                self.sampler = None
+            self.session_closed = True
+            self.checkpointer.close()
 
 
 # A general ann module = a layer of neurons (the output) plus its incoming weights and biases.
@@ -268,70 +607,739 @@ class Gannmodule():
         self.name = "Module-"+str(self.index)
         self.build()
 
+    # In an ensemble (of K members), the weights are a (K, insize, outsize) tensor and the biases (K, 1, outsize),
+    # each member's slice initialized on its own.
     def build(self):
         mona = self.name
         n = self.outsize
+        dtype = self.ann.dtype
+        members = self.ann.ensemble
         if self.usevsi:
-            initializer = tf.contrib.layers.variance_scaling_initializer(mode='FAN_IN', dtype=tf.float64)
-            self.weights = tf.Variable(initializer(shape=(self.insize, n)),
-                        name=mona+'-wgt',trainable=True)
+            initializer = tf.contrib.layers.variance_scaling_initializer(mode='FAN_IN', dtype=dtype)
+            wgts = initializer(shape=(self.insize, n)) if members == 1 else \
+                tf.stack([initializer(shape=(self.insize, n)) for m in range(members)])
+            self.weights = tf.Variable(wgts, name=mona+'-wgt',trainable=True)
         else:
-            self.weights = tf.Variable(np.random.uniform(self.wrange[0], self.wrange[1], size=(self.insize, n)),
+            shape = (self.insize, n) if members == 1 else (members, self.insize, n)
+            wgts = np.random.uniform(self.wrange[0], self.wrange[1], size=shape)
+            self.weights = tf.Variable(wgts.astype(dtype.as_numpy_dtype),
                         name=mona+'-wgt',trainable=True)  # True = default for trainable anyway
-        self.biases = tf.Variable(np.random.uniform(self.wrange[0], self.wrange[1], size=n),
+        biases = np.random.uniform(self.wrange[0], self.wrange[1], size=n if members == 1 else (members, 1, n))
+        self.biases = tf.Variable(biases.astype(dtype.as_numpy_dtype),
                     name=mona+'-bias', trainable=True)  # First bias vector
-        self.output = self.activation_func(tf.matmul(self.input, self.weights) + self.biases, name=mona+'-out')
+        self.output = self.apply(self.input, name=mona+'-out')
         self.ann.add_module(self)
 
+    # The module's computation, applied to any input tensor.
+    def apply(self, invar, name=None):
+        return self.activation_func(tf.matmul(invar, self.weights) + self.biases, name=name)
+
     def getvar(self, type):  # type = (in,out,wgt,bias)
-        return {'in': self.input, 'out': self.output, 'wgt': self.weights, 'bias': self.biases}[type]
+        var = {'in': self.input, 'out': self.output, 'wgt': self.weights, 'bias': self.biases}[type]
+        if self.ann.ensemble > 1:  # Grabvars and probes show one member of an ensemble, and are named after it.  The
+            # member is a slice of the ensemble's variables, so checkpoints and snapshots use get_state_vars instead.
+            m = self.ann.view_member
+            var = tf.identity(var[m] if type != 'bias' else var[m, 0],
+                              name=self.name + '-' + type + '-member-' + str(m))
+        return var
 
     # spec, a list, can contain one or more of (avg,max,min,hist); type = (in, out, wgt, bias)
-    def gen_probe(self, type, spec):
+    def gen_probe(self, type, spec, interval=1, sample=None):
         var = self.getvar(type)
-        base = self.name + '_' + type
+        base = self.name + '_' + type + ('_member' + str(self.ann.view_member) if self.ann.ensemble > 1 else '')
+        collections = [self.ann.probe_collection(interval)]
         with tf.name_scope('probe_'):
             if ('avg' in spec) or ('stdev' in spec):
                 avg = tf.reduce_mean(var)
             if 'avg' in spec:
-                tf.summary.scalar(base + '/avg/', avg)
+                tf.summary.scalar(base + '/avg/', avg, collections=collections)
             if 'max' in spec:
-                tf.summary.scalar(base + '/max/', tf.reduce_max(var))
+                tf.summary.scalar(base + '/max/', tf.reduce_max(var), collections=collections)
             if 'min' in spec:
-                tf.summary.scalar(base + '/min/', tf.reduce_min(var))
+                tf.summary.scalar(base + '/min/', tf.reduce_min(var), collections=collections)
             if 'hist' in spec:
-                tf.summary.histogram(base + '/hist/', var)
+                if sample:
+                    self.ann.add_reservoir(Probereservoir(base + '/hist/', var, interval, sample))
+                else:
+                    tf.summary.histogram(base + '/hist/', var, collections=collections)
+
+# *********** PROBE RESERVOIR ********
+# Collects the values of a probed variable, fetched every sample_interval steps, into a fixed-size uniform random
+# sample (reservoir sampling), and turns the sample into a histogram summary every interval steps.  The reservoir is
+# emptied after each write, so each histogram covers the steps since the previous one.
+
+class Probereservoir():
+    def __init__(self, tag, var, interval, sample_interval, size=1000):
+        self.tag = tag
+        self.var = var
+        self.interval = interval
+        self.sample_interval = sample_interval
+        self.buffer = np.zeros(size)
+        self.filled = 0  # Number of buffer slots in use
+        self.seen = 0  # Number of values offered to the reservoir since the last write
+
+    def add(self, vals):
+        vals = np.ravel(vals)
+        size = len(self.buffer)
+        head = vals[0:max(0, size - self.filled)]  # Values that go into empty slots
+        self.buffer[self.filled:self.filled + len(head)] = head
+        self.filled += len(head)
+        self.seen += len(head)
+        tail = vals[len(head):]
+        # The k'th of the remaining values replaces a random slot with probability size/(seen + k).
+        slots = (np.random.uniform(size=len(tail)) * (self.seen + np.arange(1, len(tail) + 1))).astype(int)
+        keep = slots < size
+        self.buffer[slots[keep]] = tail[keep]
+        self.seen += len(tail)
+
+    def gen_summary(self):
+        summary = TFT.gen_histogram_summary(self.tag, self.buffer[0:self.filled])
+        self.filled = 0
+        self.seen = 0
+        return summary
+
 
 # *********** CASE MANAGER ********
 # This is a simple class for organizing the cases (training, validation and test) for a
-# a machine-learning system
+# a machine-learning system.  The cases are stored column-wise, as one 2-d array of features and one of targets
+# (rows = cases).  The cases come in either as a list of [input, target] pairs or as such a pair of arrays.
+# They are shuffled once, after which each split is a contiguous slice (a view, not a copy) of the two arrays,
+# and the getters return (features, targets) pairs of those views.  Cases that already come in random order (e.g.
+# memory-mapped from the data set cache) can skip the shuffle (shuffle=False), and are then never copied at all.
+# With a scale (e.g. 1/255 for MNIST pixels), the features are kept in their original (integer) type and are only
+# multiplied by the scale when they are handed out: per minibatch for training, once for the smaller splits.
+# A normalizer (see data_prep) is fitted to the (scaled) training features and is applied in the same way, after
+# the scale, so the case arrays (which may be memory-mapped) are never copied as a whole.
+# With folds (k-fold cross-validation), the cases are instead cut into k stratified folds (see gen_stratified_folds):
+# fold number 'fold' is held out as both the validation and the test set, and the other k - 1 folds are the training
+# set, which is kept as an array of indices into the case arrays rather than copied.
+
+__fold_seed__ = 0  # Seed of the random choices behind the folds, which must be the same in every run
 
 class Caseman():
-    def __init__(self, cases, vfrac, tfrac, casefrac, mapsep):
-        self.cases = cases
+    def __init__(self, cases, vfrac, tfrac, casefrac, mapsep, dtype=np.float64, shuffle=True, normalizer=None,
+                 scale=None, folds=None, fold=0):
+        self.features, self.targets = gen_case_arrays(cases, dtype, keep_features=scale is not None)
+        self.shuffle = shuffle
+        self.folds = folds
+        self.fold = fold
+        self.training_indices = None  # Only used with folds
+        self.normalizer = normalizer
+        self.scale = scale
         self.mapsep = mapsep
+        self.dtype = dtype  # Storage type of the case arrays.  Batches are converted to the network's type when fed.
         self.validation_fraction = vfrac * casefrac
         self.test_fraction = tfrac * casefrac
         self.training_fraction = (1 - (vfrac + tfrac)) * casefrac
+        self.case_fraction = casefrac
+        if folds: self.organize_folds()
+        else: self.organize_cases()
+
+    def organize_cases(self):
+        num_cases = len(self.features)
+        if self.shuffle:
+            order = np.random.permutation(num_cases)  # Randomly shuffle all cases
+            self.features = self.features[order]
+            self.targets = self.targets[order]
+        separator1 = round(num_cases * self.training_fraction)
+        separator2 = separator1 + round(num_cases * self.validation_fraction)
+        if self.normalizer: self.fit_normalizer(self.features[0:separator1])
+        self.training_cases = (self.features[0:separator1], self.targets[0:separator1])
+        self.validation_cases = self.prepared((self.features[separator1:separator2],
+                                               self.targets[separator1:separator2]))
+        self.testing_cases = self.prepared((self.features[separator2:], self.targets[separator2:]))
+        mapping = np.random.permutation(num_cases)[0:min(self.mapsep, num_cases)]
+        self.mapping_cases = self.prepared((self.features[mapping], self.targets[mapping]))
+
+    # The folds are the same in every run (and every process) with the same cases and folds, so the k runs of a
+    # cross-validation each hold out a different part of one partition.  With casefrac < 1, the cases used are a
+    # random subset drawn from a fixed seed (not the head of the arrays, which may be sorted by class).  The folds are
+    # dealt out at random anyway, so shuffle does not apply, and neither do vfrac and tfrac.
+    def organize_folds(self):
+        num_cases = round(len(self.features) * self.case_fraction)
+        if num_cases < len(self.features):
+            subset = np.sort(np.random.RandomState(__fold_seed__).permutation(len(self.features))[0:num_cases])
+        else:
+            subset = np.arange(num_cases)
+        fold_of = gen_stratified_folds(self.targets[subset], self.folds, seed=__fold_seed__)
+        held_out = subset[fold_of == self.fold]
+        self.training_indices = subset[fold_of != self.fold]
+        if self.normalizer: self.fit_normalizer(self.features, rows=self.training_indices)
+        self.training_cases = (self.features, self.targets)  # Read through self.training_indices
+        self.validation_cases = self.prepared((self.features[held_out], self.targets[held_out]))
+        self.testing_cases = self.validation_cases
+        mapping = np.random.permutation(self.training_indices)[0:min(self.mapsep, len(self.training_indices))]
+        self.mapping_cases = self.prepared((self.features[mapping], self.targets[mapping]))
+
+    # The normalizer is fitted block by block to the unscaled features.  Since the scale is linear, the statistics
+    # of the scaled features are those statistics times the scale.
+    def fit_normalizer(self, features, rows=None):
+        self.normalizer.fit(features, rows=rows)
+        if self.scale is not None:
+            self.normalizer.offset = self.normalizer.offset * self.scale
+            self.normalizer.scale = self.normalizer.scale * self.scale
+
+    def prepared(self, cases):
+        return prepare_features(cases[0], self.scale, self.normalizer, self.dtype), cases[1]
+
+    # The sampler indexes straight into the training slices of the case arrays (or, with folds, through the
+    # training indices).
+    def gen_sampler(self, mbs, replace=False, epoch=None):
+        features, targets = self.training_cases
+        return Casesampler(features, targets, mbs, replace=replace, epoch=epoch, scale=self.scale, dtype=self.dtype,
+                           indices=self.training_indices, normalizer=self.normalizer)
+
+    # Number of cases returned by get_training_cases, without gathering them.
+    def get_training_size(self):
+        return len(self.training_cases[1]) if self.training_indices is None else len(self.training_indices)
+
+    def get_training_cases(self):
+        if self.training_indices is None: return self.prepared(self.training_cases)
+        indices = self.training_indices
+        return self.prepared((self.training_cases[0][indices], self.training_cases[1][indices]))
+    def get_validation_cases(self): return self.validation_cases
+    def get_testing_cases(self): return self.testing_cases
+    def get_mapping_cases(self): return self.mapping_cases
+
+
+# Convert a list of [input, target] pairs, or a (features, targets) pair of arrays, into two 2-d arrays of type dtype.
+# With keep_features, a features array keeps its own type (e.g. uint8 pixels that are scaled later).
+def gen_case_arrays(cases, dtype=np.float64, keep_features=False):
+    if isinstance(cases, tuple) and len(cases) == 2 and isinstance(cases[0], np.ndarray):
+        features = cases[0] if keep_features else np.asarray(cases[0], dtype=dtype)
+        return features, np.asarray(cases[1], dtype=dtype)
+    features = np.array([c[0] for c in cases], dtype=dtype)
+    targets = np.array([c[1] for c in cases], dtype=dtype)
+    return features, targets
+
+
+def scale_features(features, scale, dtype=np.float64):
+    return np.multiply(features, scale, dtype=dtype)
+
+
+# The features as the network sees them: scaled and then normalized (either one only when given).
+def prepare_features(features, scale=None, normalizer=None, dtype=np.float64):
+    if scale is not None: features = scale_features(features, scale, dtype)
+    if normalizer: features = normalizer.transform(np.asarray(features, dtype=dtype))
+    return features
+
+
+# Assign each case to one of k folds, stratified by class (the largest target value, so one-hot targets) so that
+# every fold has (within one case) the same share of each class.  Within a class, the cases are dealt out to the
+# folds in an order drawn from a fixed seed, so the folds depend only on the targets, k and the seed.  Returns the
+# fold number of each case.
+def gen_stratified_folds(targets, k, seed=0):
+    num_cases = len(targets)
+    if k < 2 or k > num_cases:
+        raise ValueError("the number of folds must be between 2 and the number of cases")
+    labels = np.argmax(np.asarray(targets), axis=1) if np.ndim(targets) > 1 else np.asarray(targets)
+    order = np.lexsort((np.random.RandomState(seed).random_sample(num_cases), labels))
+    fold_of = np.empty(num_cases, dtype=int)
+    fold_of[order] = np.arange(num_cases) % k
+    return fold_of
+
+
+# *********** STREAMING CASE MANAGER ********
+# A case manager for data sets that do not fit in memory.  The cases are read, one chunk at a time, by a reader (see
+# Npyreader and Textreader below), and each case goes to the training, validation or test set according to a seeded
+# hash of its row index, so the split needs no memory and is the same on every pass through the data.  One initial pass
+# collects the validation and test sets (at most evalcap cases each), a sample of the training cases (for
+# test_on_trains) and the mapping cases.  Training minibatches then come from a Streamsampler, which keeps a bounded
+# shuffle buffer filled from an endless stream of training cases.
+
+class Streamcaseman():
+    def __init__(self, reader, vfrac, tfrac, casefrac, mapsep, dtype=np.float64, buffer=10000, evalcap=10000,
+                 normalizer=None, seed=0):
+        self.reader = reader
+        self.normalizer = normalizer  # Fitted to the training sample, then applied to every streamed chunk
+        self.seed = seed  # Of the split
+        self.mapsep = mapsep
+        self.dtype = dtype
+        self.buffer_size = buffer
+        self.evalcap = evalcap  # Maximum number of cases in the validation, test and training-sample sets
+        self.validation_fraction = vfrac * casefrac
+        self.test_fraction = tfrac * casefrac
+        self.case_fraction = casefrac
         self.organize_cases()
 
+    # Each case's place in [0, 1), from the splitmix64 hash of its row index (offset by the seed).  Unlike a plain
+    # multiplicative hash, whose values step evenly through [0, 1) as the row index grows, this shows no pattern
+    # in row order, so a sorted file (e.g. by class) still gets a random-looking split.
+    def hash_rows(self, start, count):
+        z = np.arange(start, start + count, dtype=np.uint64) + np.uint64((self.seed + 1) * 0x9E3779B97F4A7C15 % 2**64)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+        return (z >> np.uint64(11)) / 2.0**53
+
+    # The split (0 = training, 1 = validation, 2 = testing, 3 = unused) of each case in a chunk.
+    def split_rows(self, start, count):
+        h = self.hash_rows(start, count)
+        bounds = [self.validation_fraction, self.validation_fraction + self.test_fraction, self.case_fraction]
+        split = np.zeros(count, dtype=int)
+        split[h >= bounds[2]] = 3
+        split[h < bounds[1]] = 2
+        split[h < bounds[0]] = 1
+        return split
+
     def organize_cases(self):
-        ca = np.array(self.cases)
-        np.random.shuffle(ca) # Randomly shuffle all cases
-        separator1 = round(len(self.cases) * self.training_fraction)
-        separator2 = separator1 + round(len(self.cases) * self.validation_fraction)
-        self.training_cases = ca[0:separator1]
-        self.validation_cases = ca[separator1:separator2]
-        self.testing_cases = ca[separator2:]
-        np.random.shuffle(ca)
-        self.mapping_cases = ca[0:min(self.mapsep, len(ca))]
+        collected = {0: ([], []), 1: ([], []), 2: ([], [])}
+        counts = {0: 0, 1: 0, 2: 0}
+        self.num_training_cases = 0
+        start = 0
+        for features, targets in self.reader.chunks():
+            split = self.split_rows(start, len(features))
+            self.num_training_cases += np.sum(split == 0)
+            for s in collected:
+                room = self.evalcap - counts[s]
+                rows = np.nonzero(split == s)[0][0:room]
+                if len(rows) > 0:
+                    collected[s][0].append(np.asarray(features[rows], dtype=self.dtype))
+                    collected[s][1].append(np.asarray(targets[rows], dtype=self.dtype))
+                    counts[s] += len(rows)
+            start += len(features)
+        if self.num_training_cases == 0:
+            raise ValueError("the streamed data set has no training cases")
+        empty = (np.zeros((0, self.reader.num_inputs), dtype=self.dtype),
+                 np.zeros((0, self.reader.num_outputs), dtype=self.dtype))
+        arrays = {s: (np.concatenate(f), np.concatenate(t)) if f else empty for s, (f, t) in collected.items()}
+        if self.normalizer:
+            self.normalizer.fit(arrays[0][0])
+            arrays = {s: (self.normalizer.transform(f), t) for s, (f, t) in arrays.items()}
+        self.training_cases = arrays[0]  # Only a sample of (at most evalcap) training cases
+        self.validation_cases = arrays[1]
+        self.testing_cases = arrays[2]
+        self.mapping_cases = (arrays[0][0][0:self.mapsep], arrays[0][1][0:self.mapsep])
+
+    # An endless stream of chunks of training cases: pass after pass through the data set.
+    def gen_training_chunks(self):
+        while True:
+            start = 0
+            for features, targets in self.reader.chunks():
+                count = len(features)
+                rows = np.nonzero(self.split_rows(start, count) == 0)[0]
+                if len(rows) > 0:
+                    features = np.asarray(features[rows], dtype=self.dtype)
+                    if self.normalizer:
+                        features = self.normalizer.transform(features)
+                    yield features, np.asarray(targets[rows], dtype=self.dtype)
+                start += count
 
+    # Sampling is always without replacement from the shuffle buffer; replace and epoch do not apply to a stream.
+    def gen_sampler(self, mbs, replace=False, epoch=None):
+        return Streamsampler(self.gen_training_chunks(), mbs, min(self.buffer_size, self.num_training_cases))
+
+    def get_training_size(self): return len(self.training_cases[1])
     def get_training_cases(self): return self.training_cases
     def get_validation_cases(self): return self.validation_cases
     def get_testing_cases(self): return self.testing_cases
     def get_mapping_cases(self): return self.mapping_cases
 
 
+# Each minibatch is a random selection of cases from the shuffle buffer, whose places are then taken by the next
+# cases in the stream.  There is no in-memory copy of the training set, hence features = targets = None.
+class Streamsampler():
+    def __init__(self, stream, mbs, buffer):
+        self.stream = stream
+        self.minibatch_size = mbs
+        self.features = None
+        self.targets = None
+        self.chunk = next(self.stream)
+        self.cursor = 0
+        self.buffer_features, self.buffer_targets = self.take(buffer)
+
+    # The next n cases of the stream.
+    def take(self, n):
+        features, targets = [], []
+        while n > 0:
+            if self.cursor >= len(self.chunk[0]):
+                self.chunk = next(self.stream)
+                self.cursor = 0
+            m = min(n, len(self.chunk[0]) - self.cursor)
+            features.append(self.chunk[0][self.cursor:self.cursor + m])
+            targets.append(self.chunk[1][self.cursor:self.cursor + m])
+            self.cursor += m
+            n -= m
+        return np.concatenate(features), np.concatenate(targets)
+
+    def next_batch(self):
+        size = len(self.buffer_features)
+        slots = np.array(random.sample(range(size), min(self.minibatch_size, size)))
+        batch = self.buffer_features[slots], self.buffer_targets[slots]
+        self.buffer_features[slots], self.buffer_targets[slots] = self.take(len(slots))
+        return batch
+
+
+# Readers deliver a data set from disk as a series of (features, targets) chunks, starting over on every call to
+# chunks().  Npyreader reads a pair of .npy files (memory-mapped, so only one chunk is ever in memory).
+class Npyreader():
+    def __init__(self, features_path, targets_path, chunk=10000):
+        self.features = np.load(features_path, mmap_mode='r')
+        self.targets = np.load(targets_path, mmap_mode='r')
+        self.chunk = chunk
+        self.num_inputs = self.features.shape[1]
+        self.num_outputs = self.targets.shape[1]
+
+    def chunks(self):
+        for start in range(0, len(self.features), self.chunk):
+            yield np.array(self.features[start:start + self.chunk]), np.array(self.targets[start:start + self.chunk])
+
+
+# Textreader reads the same ';' or ',' delimited format as the data_set_files: one case per line, features
+# first and a (1-based) class label last, which becomes a one-hot target.  '?' fields become the missing value.
+# When the number of classes is not given, an extra pass through the file finds the largest label.
+class Textreader():
+    def __init__(self, path, classes=None, chunk=10000, missing=0):
+        self.path = path
+        self.chunk = chunk
+        self.missing = missing
+        self.classes = classes if classes else max(int(np.max(d[:, -1])) for d in self.read_chunks())
+        with open(path) as file:  # The number of fields of the first case
+            line = next(l for l in file if l.strip())
+        self.num_inputs = data_prep.parse_delimited_text(line, missing=missing).shape[1] - 1
+        self.num_outputs = self.classes
+
+    def read_chunks(self):
+        with open(self.path) as file:
+            for data in data_prep.read_delimited_chunks(file, chunk=self.chunk, missing=self.missing):
+                yield data
+
+    def chunks(self):
+        for data in self.read_chunks():
+            features, labels = data_prep.split_labels(data)
+            yield features, np.eye(self.classes)[labels]
+
+
+# *********** GENERATED CASES ********
+# For synthetic sources, fresh training cases can be generated on the fly instead of drawn from a fixed data set.
+# A Casegenerator wraps a function that returns (features, targets) arrays of any number of new random cases, along
+# with the nominal size of the data set.  The Gencaseman generates fixed validation and test sets (and a sample of
+# training cases, for test_on_trains and mapping) of the sizes that a Caseman would give that data set, while the
+# training minibatches come from a Gensampler and are never stored.
+
+class Casegenerator():
+    def __init__(self, func, size):
+        self.func = func
+        self.size = size
+        features, targets = func(1)
+        self.num_inputs, self.num_outputs = features.shape[1], targets.shape[1]
+
+    def __call__(self, count): return self.func(count)
+
+
+class Gencaseman():
+    def __init__(self, generator, vfrac, tfrac, casefrac, mapsep, dtype=np.float64, producer=None, qsize=10,
+                 block=100):
+        self.generator = generator
+        self.normalizer = None
+        self.mapsep = mapsep
+        self.dtype = dtype
+        self.producer = producer  # None, 'thread' or 'process'
+        self.queue_size = qsize
+        self.block = block
+        size = generator.size * casefrac
+        self.validation_cases = self.gen_cases(round(size * vfrac))
+        self.testing_cases = self.gen_cases(round(size * tfrac))
+        self.training_cases = self.gen_cases(round(size * (1 - (vfrac + tfrac))))
+        self.mapping_cases = (self.training_cases[0][0:mapsep], self.training_cases[1][0:mapsep])
+
+    def gen_cases(self, count):
+        features, targets = self.generator(count)
+        return np.asarray(features, dtype=self.dtype), np.asarray(targets, dtype=self.dtype)
+
+    # Every minibatch is new, so replace and epoch do not apply.
+    def gen_sampler(self, mbs, replace=False, epoch=None):
+        return Gensampler(self.generator, mbs, dtype=self.dtype, producer=self.producer, qsize=self.queue_size,
+                          block=self.block)
+
+    def get_training_size(self): return len(self.training_cases[1])
+    def get_training_cases(self): return self.training_cases
+    def get_validation_cases(self): return self.validation_cases
+    def get_testing_cases(self): return self.testing_cases
+    def get_mapping_cases(self): return self.mapping_cases
+
+
+# The generator is called for block minibatches at a time, since the array generators cost little more for many
+# cases than for one.  With producer='thread' or 'process', the blocks are generated in the background and handed
+# over through a queue of at most qsize blocks, so generation overlaps with training without running far ahead.
+# There is no fixed training set, hence features = targets = None.
+class Gensampler():
+    def __init__(self, generator, mbs, dtype=np.float64, producer=None, qsize=10, block=100):
+        self.generator = generator
+        self.minibatch_size = mbs
+        self.dtype = dtype
+        self.block_size = mbs * block
+        self.features = None
+        self.targets = None
+        self.worker = None
+        self.stop = threading.Event()
+        if producer == 'thread':
+            self.blocks = queue.Queue(qsize)
+            self.worker = threading.Thread(target=produce_case_blocks, daemon=True,
+                                           args=(generator, self.block_size, self.blocks, self.stop))
+        elif producer == 'process':  # Spawned rather than forked, as forking a process with running threads is unsafe
+            context = multiprocessing.get_context('spawn')
+            self.blocks = context.Queue(qsize)
+            self.worker = context.Process(target=produce_case_blocks, args=(generator, self.block_size, self.blocks),
+                                          daemon=True)
+        elif producer is not None:
+            raise ValueError("producer must be 'thread', 'process' or None")
+        if self.worker: self.worker.start()
+        self.block = self.next_block()
+        self.cursor = 0
+
+    def next_block(self):
+        features, targets = self.blocks.get() if self.worker else self.generator(self.block_size)
+        return np.asarray(features, dtype=self.dtype), np.asarray(targets, dtype=self.dtype)
+
+    def next_batch(self):
+        if self.cursor >= len(self.block[0]):
+            self.block = self.next_block()
+            self.cursor = 0
+        mbs = self.minibatch_size
+        batch = self.block[0][self.cursor:self.cursor + mbs], self.block[1][self.cursor:self.cursor + mbs]
+        self.cursor += mbs
+        return batch
+
+    # A producer thread is told to stop and, should it be waiting for room in the full queue, given some, so that it
+    # can finish.  A producer process is simply terminated.
+    def close(self):
+        if isinstance(self.worker, multiprocessing.process.BaseProcess):
+            self.worker.terminate()
+            self.worker.join()
+        elif self.worker:
+            self.stop.set()
+            while self.worker.is_alive():
+                try:
+                    self.blocks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.worker.join()
+        self.worker = None
+
+
+# The producer loop of a Gensampler, which runs until stop (if any) is set.
+def produce_case_blocks(generator, size, blocks, stop=None):
+    while not (stop and stop.is_set()):
+        blocks.put(generator(size))
+
+
+# *********** CASE SAMPLER ********
+# Hands out training minibatches by indexing into contiguous feature and target arrays, so the cost of a step
+# depends only on the minibatch size and not on the size of the data set.  Without replacement, the cases are
+# visited in a fresh random permutation each epoch (an epoch is 'epoch' cases long, or all of them when None).
+# With replacement, every minibatch is an independent uniform draw.  With indices, only the cases at those rows of
+# the arrays are sampled (e.g. the training folds of a cross-validation), still without copying them.
+
+class Casesampler():
+    def __init__(self, features, targets, mbs, replace=False, epoch=None, scale=None, dtype=np.float64, indices=None,
+                 normalizer=None):
+        self.features = features
+        self.targets = targets
+        self.indices = indices
+        self.scale = scale  # Applied to each batch of features (see Caseman), and then the normalizer
+        self.normalizer = normalizer
+        self.dtype = dtype
+        self.minibatch_size = mbs
+        self.replace = replace
+        self.num_cases = len(features) if indices is None else len(indices)
+        self.epoch_size = min(epoch, self.num_cases) if epoch else self.num_cases
+        self.epochs = 0  # Number of completed epochs
+        self.new_epoch()
+
+    def new_epoch(self):
+        self.order = np.random.permutation(self.num_cases)[0:self.epoch_size]
+        self.cursor = 0
+
+    def next_indices(self):
+        mbs = self.minibatch_size
+        if self.replace:
+            return np.random.randint(0, self.num_cases, size=mbs)
+        if self.cursor + mbs > len(self.order):  # Not enough cases left for a full minibatch, so start a new epoch
+            self.epochs += 1
+            self.new_epoch()
+        indices = self.order[self.cursor:self.cursor + mbs]
+        self.cursor += mbs
+        return indices
+
+    def next_batch(self):
+        indices = self.next_indices()
+        if self.indices is not None: indices = self.indices[indices]
+        features = prepare_features(self.features[indices], self.scale, self.normalizer, self.dtype)
+        return features, self.targets[indices]
+
+    # All the training cases at once, prepared (used to load them into the graph for pipelined or fused training).
+    def get_cases(self):
+        features, targets = self.features, self.targets
+        if self.indices is not None: features, targets = features[self.indices], targets[self.indices]
+        return prepare_features(features, self.scale, self.normalizer, self.dtype), targets
+
+
+# *********** SNAPSHOT WORKER ********
+# A background thread with its own session on the Gann's graph.  Each job is submitted along with a snapshot of the
+# weights and biases, taken between two training steps.  Before running a job, the worker loads the snapshot into
+# its own session's copy of the variables, so the job sees the network exactly as it was at the snapshot's step,
+# no matter how far training has moved on since.  Jobs run one at a time, in the order they were submitted.  A job
+# that fails does not stop the worker: its exception (the first one, if several fail) is raised again in the thread
+# that next calls wait or close.
+
+class Snapshotworker():
+    def __init__(self, ann):
+        self.ann = ann
+        self.session = TFT.gen_session()
+        self.jobs = queue.Queue()
+        self.error = None  # The first exception raised by a job, until it is passed on by wait or close
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def submit(self, job, snapshot, *args):
+        self.jobs.put((job, snapshot, args))
+
+    def work(self):
+        while True:
+            job, snapshot, args = self.jobs.get()
+            try:
+                if job is None: return
+                self.ann.load_snapshot(self.session, snapshot)
+                job(self.session, *args)
+            except Exception as e:
+                if self.error is None: self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def raise_error(self):
+        error, self.error = self.error, None
+        if error is not None: raise error
+
+    # Block until every submitted job has been run.
+    def wait(self):
+        self.jobs.join()
+        self.raise_error()
+
+    # The jobs submitted before the close are still run.
+    def close(self):
+        self.jobs.put((None, None, ()))
+        self.thread.join()
+        self.session.close()
+        self.raise_error()
+
+
+# *********** CHECKPOINTER ********
+# Writes checkpoints of the weights and biases from snapshots, on a Snapshotworker's thread, so that training never
+# waits for the disk.  Its two Savers are created once per Gann: one for the periodic checkpoints (of which the
+# latest 'keep' are retained) and one for the checkpoint with the best validation error so far.  A checkpoint is
+# numbered by the number of training steps behind it, and asking for the same number twice writes it only once.
+# Checkpoints are asked for from both the training loop and the validator's thread, so the worker is started under
+# a lock: there is only ever one, and it writes the checkpoints in the order they were asked for.
+
+class Checkpointer():
+    def __init__(self, ann, spath='netsaver/my_saved_session', keep=5):
+        self.ann = ann
+        self.spath = spath
+        state_vars = ann.get_state_vars()
+        self.saver = tf.train.Saver(state_vars, max_to_keep=keep)
+        self.best_saver = tf.train.Saver(state_vars, max_to_keep=1)
+        self.worker = None  # Started by the first save after creation or close
+        self.lock = threading.Lock()
+        self.saved_step = None  # Number of the latest requested periodic checkpoint
+        self.saved_path = None  # Path of the latest written periodic checkpoint
+        self.best_error = None
+        self.best_path = None
+        self.normalizer_saved = False
+        if os.path.dirname(spath):
+            os.makedirs(os.path.dirname(spath), exist_ok=True)
+
+    def submit(self, job, snapshot, step):
+        with self.lock:
+            if self.worker is None:
+                self.worker = Snapshotworker(self.ann)
+            self.worker.submit(job, snapshot, step)
+
+    def save(self, snapshot, step):
+        if step != self.saved_step:
+            self.saved_step = step
+            self.submit(self.write, snapshot, step)
+
+    # Called after each validation test, with the session that holds the tested weights.
+    def consider_best(self, sess, step, error):
+        if self.best_error is None or error < self.best_error:
+            self.best_error = error
+            self.submit(self.write_best, self.ann.gen_snapshot(sess), step)
+
+    # The normalizer is saved (once) next to the checkpoints, as <spath>-normalizer.npz.
+    def write(self, sess, step):
+        self.saved_path = self.saver.save(sess, self.spath, global_step=step, write_meta_graph=False)
+        if self.ann.normalizer and not self.normalizer_saved:
+            self.ann.normalizer.save(self.spath + '-normalizer.npz')
+            self.normalizer_saved = True
+
+    def write_best(self, sess, step):
+        self.best_path = self.best_saver.save(sess, self.spath + '-best', global_step=step,
+                                              latest_filename='checkpoint-best', write_meta_graph=False)
+
+    def wait(self):
+        if self.worker: self.worker.wait()
+
+    # Write the outstanding checkpoints, then stop the worker's thread and close its session.
+    def close(self):
+        with self.lock:
+            if self.worker:
+                worker, self.worker = self.worker, None
+                worker.close()
+
+    # Path of the latest periodic checkpoint, once it has been written.
+    def latest(self):
+        self.wait()
+        return self.saved_path
+
+
+# *********** INPUT PIPELINE ********
+# A tf.data pipeline that shuffles, batches and prefetches cases, so that host-side batching overlaps with the
+# computation of the previous step.  The cases enter through placeholders (and are thus not baked into the graph as
+# constants).  There are two iterators: one over the training data (shuffled, repeated forever) and one over a
+# validation/testing set (one pass, unshuffled).  The network reads from the training iterator unless the
+# evaluation iterator's handle is fed, so a test never disturbs the training stream: once started, it runs on,
+# with its shuffle buffer full, for as long as the session lives.
+
+class Gannpipeline():
+    def __init__(self, num_inputs, num_outputs, dtype=tf.float64, buffer=10000, prefetch=2):
+        self.buffer_limit = buffer
+        self.features = tf.placeholder(dtype, shape=(None, num_inputs), name='Pipeline-features')
+        self.targets = tf.placeholder(dtype, shape=(None, num_outputs), name='Pipeline-targets')
+        self.batch_size = tf.placeholder(tf.int64, shape=(), name='Pipeline-batch-size')
+        self.buffer_size = tf.placeholder(tf.int64, shape=(), name='Pipeline-buffer-size')
+        cases = tf.data.Dataset.from_tensor_slices((self.features, self.targets))
+        training = cases.shuffle(self.buffer_size).repeat().batch(self.batch_size).prefetch(prefetch)
+        evaluation = cases.batch(self.batch_size).prefetch(prefetch)
+        self.training_iterator = training.make_initializable_iterator()
+        self.evaluation_iterator = evaluation.make_initializable_iterator()
+        self.evaluation_handle = self.evaluation_iterator.string_handle()
+        self.handle = tf.placeholder_with_default(self.training_iterator.string_handle(), shape=(),
+                                                  name='Pipeline-handle')
+        iterator = tf.data.Iterator.from_string_handle(self.handle, training.output_types, training.output_shapes)
+        self.input, self.target = iterator.get_next()
+        self.session = None  # The session whose training iterator has been started
+        self.handles = {}  # session => the value of its evaluation iterator's handle
+
+    # Training should only be started once per session (see running), so successive training steps keep drawing
+    # from the same shuffled stream.
+    def running(self, sess):
+        return self.session is sess
+
+    # Point an iterator at a data set.  For an evaluation split, the returned feed_dict makes a run read from it.
+    def start(self, sess, split, features, targets, batch_size):
+        feeder = {self.features: features, self.targets: targets, self.batch_size: batch_size,
+                  self.buffer_size: min(len(features), self.buffer_limit)}
+        if split == 'training':
+            sess.run(self.training_iterator.initializer, feed_dict=feeder)
+            self.session = sess
+            return None
+        sess.run(self.evaluation_iterator.initializer, feed_dict=feeder)
+        if sess not in self.handles:
+            self.handles = {sess: sess.run(self.evaluation_handle)}  # Only the current session's is needed
+        return {self.handle: self.handles[sess]}
+
+
 #   ****  MAIN functions ****
 
 # After running this, open a Tensorboard (Go to localhost:6006 in your Chrome Browser) and check the
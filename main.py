@@ -3,10 +3,11 @@ import gann_base
 # import tensorflow as tf
 import tflowtools as TFT
 import numpy as np
+import os
+import time
 
 
 # TODO: optimizers needs arguments
-# TODO: must normalize input from .txt files
 # TODO: source needs more arguments, readfunctions etc
 
 # NOTE: use softmax for ofunc and cross_entropy as loss for classification
@@ -14,25 +15,69 @@ import numpy as np
 
 
 def main():
+    run()
+
+# Run one configuration, given as a list of command-line arguments (by default those of this process).  With
+# view=False (e.g. in a sweep), the mapping test and all displays are skipped.  With an outdir, the tensorboard logs
+# and checkpoints go there instead of to probeview and netsaver.  Returns a dictionary of the final results.
+# TensorFlow sizes its thread pools once per process, and the CPU affinity holds for the whole process, so a caller
+# that runs many configurations in one process (a sweep worker) sets those once and passes its (intra, inter)
+# thread counts as threads; the configuration's own --intra, --inter and --affinity are then not applied.
+def run(args=None, view=True, outdir=None, threads=None):
+    start = time.time()
     parser = argument_parser.argument_parser()
-    parser.parse()
+    parser.parse(args)
     parser.organize()
-    # (self, cases, vfrac, tfrac, casefrac, mapsep)
-    caseman = gann_base.Caseman(parser.data_set_v, parser.vfrac_v, parser.tfrac_v, parser.casefrac_v, parser.mapbs_v)
-    # (self, dims, cman, afunc, ofunc, cfunc, optimizer, lrate, wrange, vint, mbs, usevsi, showint=None):
+    intra, inter = threads if threads else (parser.intra_v, parser.inter_v)
+    TFT.set_session_config(TFT.gen_session_config(intra=intra, inter=inter, optlevel=parser.optlevel_v,
+                xla=parser.xla_v))
+    if parser.affinity_v and not threads:
+        TFT.pin_cpus(parser.affinity_v)
+    viewdir, savepath = "probeview", "netsaver/my_saved_session"
+    if outdir is not None:
+        viewdir, savepath = os.path.join(outdir, viewdir), os.path.join(outdir, savepath)
+    if parser.onthefly_v:
+        # (self, generator, vfrac, tfrac, casefrac, mapsep, dtype=np.float64, producer=None, qsize=10, block=100)
+        caseman = gann_base.Gencaseman(parser.data_set_v, parser.vfrac_v, parser.tfrac_v, parser.casefrac_v,
+                    parser.mapbs_v, dtype=parser.storage_v, producer=parser.producer_v)
+    elif parser.stream_v:
+        # (self, reader, vfrac, tfrac, casefrac, mapsep, dtype=np.float64, buffer=10000, evalcap=10000,
+        #  normalizer=None, seed=0)
+        caseman = gann_base.Streamcaseman(parser.data_set_v, parser.vfrac_v, parser.tfrac_v, parser.casefrac_v,
+                    parser.mapbs_v, dtype=parser.storage_v, normalizer=parser.normalizer_v)
+    else:
+        # (self, cases, vfrac, tfrac, casefrac, mapsep, dtype=np.float64, shuffle=True, normalizer=None,
+        #  scale=None, folds=None, fold=0)
+        caseman = gann_base.Caseman(parser.data_set_v, parser.vfrac_v, parser.tfrac_v, parser.casefrac_v,
+                    parser.mapbs_v, dtype=parser.storage_v, shuffle=not parser.shuffled_v,
+                    normalizer=parser.normalizer_v, scale=parser.scale_v, folds=parser.folds_v, fold=parser.fold_v)
+    # (self, dims, cman, afunc, ofunc, cfunc, optimizer, lrate, wrange, vint, mbs, usevsi, showint=None,
+    #  replace=False, epoch=None, pipeline=False, fused=1, precision=tf.float64, asyncval=False,
+    #  ckint=None, ckkeep=5, keepsession=False, viewdir='probeview', savepath='netsaver/my_saved_session',
+    #  towers=1, ensemble=1, bootstrap=False):
     ann = gann_base.Gann(parser.dims_v, caseman, parser.afunc_v, parser.ofunc_v, parser.cfunc_v, parser.optimizer_v,
                 parser.lrate_v, parser.wrange_v, parser.vint_v, parser.mbs_v, parser.usevsi_v,
-                showint=parser.steps_v-1)
+                showint=parser.steps_v-1, replace=parser.replace_v, epoch=parser.epoch_v,
+                pipeline=parser.pipeline_v, fused=parser.fused_v, precision=parser.precision_v,
+                asyncval=parser.asyncval_v, ckint=parser.ckint_v, ckkeep=parser.ckkeep_v,
+                keepsession=parser.keepsession_v, viewdir=viewdir, savepath=savepath, towers=parser.towers_v,
+                ensemble=parser.ensemble_v, bootstrap=parser.bootstrap_v)
 
     for layer in parser.dispw_v:
         ann.add_grabvar(layer, type='wgt')
-        ann.gen_probe(layer, 'wgt', 'hist')
+        ann.gen_probe(layer, 'wgt', 'hist', interval=parser.probeint_v, sample=parser.probesample_v)
     for layer in parser.dispb_v:
         ann.add_grabvar(layer, type='bias')
-        ann.gen_probe(layer, 'bias', 'hist')
+        ann.gen_probe(layer, 'bias', 'hist', interval=parser.probeint_v, sample=parser.probesample_v)
 
     # run, then map
-    ann.run(steps=parser.steps_v, sess=None, continued=False, bestk=parser.best1_v)
+    training, testing = ann.run(steps=parser.steps_v, sess=None, continued=False, bestk=parser.best1_v)
+    results = gen_results(ann, caseman, training, testing, parser.best1_v, time.time() - start)
+    if not view:
+        if parser.keepsession_v:
+            ann.close_current_session(view=False, final=True)
+        gann_base.PLT.close('all')
+        return results
 
     ann.remove_grabvars()
     for layer in parser.maplayers_v:
@@ -40,21 +85,33 @@ def main():
             ann.add_grabvar(layer, type='in', add_figure=False)
         else:
             ann.add_grabvar(layer - 1, type='out', add_figure=False)
-    res, labs = ann.do_mapping()
-    results = []
-    for i in range(len(res[0])):
-        l = np.array([r[i] for r in res])
-        l = l.reshape(l.shape[0], l.shape[2])
-        TFT.hinton_plot(l, title="mapping test output of layer " + str(parser.maplayers_v[i]))
-        results.append(l)
-
-    for i, r in enumerate(results):
+    activations, labs = ann.do_mapping()
+    if parser.keepsession_v:
+        ann.close_current_session(view=False, final=True)
+    for i, l in enumerate(activations):
+        TFT.hinton_plot(l, title="mapping test output of layer " + str(parser.maplayers_v[i]) + ann.view_label())
+
+    for i, r in enumerate(activations):
         # DENDOGRAM
         # if parser.maplayers_v[i] in parser.mapdend_v:
         if parser.best1_v:
-            TFT.dendrogram(r, list(map(TFT.one_hot_to_int, labs)), title="Dendrogram " + str(parser.maplayers_v[i]))
+            TFT.dendrogram(r, list(np.argmax(labs, axis=1)),
+                           title="Dendrogram " + str(parser.maplayers_v[i]) + ann.view_label())
 
     gann_base.PLT.show()
-    TFT.fireup_tensorboard('probeview')
+    TFT.fireup_tensorboard(viewdir)
+    return results
+
+# The error of the last training step and of the last validation test, and the fraction of correctly classified
+# training and testing cases (only when testing with bestk).
+def gen_results(ann, caseman, training, testing, bestk, seconds):
+    def fraction(correct, size): return correct / size if bestk and correct is not None else None
+    return {'error': ann.error_history[-1][1] if ann.error_history else None,
+            'validation_error': ann.validation_history[-1][1] if ann.validation_history else None,
+            'training_accuracy': fraction(training, caseman.get_training_size()),
+            'testing_accuracy': fraction(testing, len(caseman.get_testing_cases()[1])),
+            'seconds': seconds}
 
-main()
+# Guarded, so that spawned processes (see gann_base.Gensampler and sweep.py) can import this module.
+if __name__ == "__main__":
+    main()
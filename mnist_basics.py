@@ -5,7 +5,6 @@ __author__ = 'keithd'
 
 import os, struct
 import time
-from array import array as pyarray
 import matplotlib.pyplot as pyplot
 import numpy
 import pickle
@@ -40,6 +39,16 @@ __mnist_path__ = "/home/kasparov/Documents/IT3105-deepnet-iface/mnist/"
 # 2) labels - a 2-dimensional numpy array whose first dimension is the number of images in subset and whose second
 # dimension is always 1.   Check it out by calling and examining the results.
 
+# The idx files are memory-mapped as uint8 arrays, right past their headers (8 bytes for labels, 16 for images), so
+# nothing is read from disk until it is used.
+
+def map_mnist_files(fname_lbl, fname_img):
+    with open(fname_img, 'rb') as fimg:
+        magic_nr, size, rows, cols = struct.unpack(">IIII", fimg.read(16))
+    labels = numpy.memmap(fname_lbl, dtype=numpy.uint8, mode='r', offset=8, shape=(size,))
+    images = numpy.memmap(fname_img, dtype=numpy.uint8, mode='r', offset=16, shape=(size, rows, cols))
+    return labels, images
+
 def load_mnist(dataset="training", digits=numpy.arange(10), path= __mnist_path__):
 
     if dataset == "training":
@@ -51,26 +60,23 @@ def load_mnist(dataset="training", digits=numpy.arange(10), path= __mnist_path__
     else:
         raise ValueError("dataset must be 'testing' or 'training'")
 
-    flbl = open(fname_lbl, 'rb')
-    magic_nr, size = struct.unpack(">II", flbl.read(8))
-    lbl = pyarray("b", flbl.read())
-    flbl.close()
-
-    fimg = open(fname_img, 'rb')
-    magic_nr, size, rows, cols = struct.unpack(">IIII", fimg.read(16))
-    img = pyarray("B", fimg.read())
-    fimg.close()
+    labels_all, images_all = map_mnist_files(fname_lbl, fname_img)
+    mask = numpy.isin(labels_all, digits)
+    if mask.all():  # No filtering needed, so the images stay a view onto the memory-mapped file
+        images, labels = images_all, labels_all
+    else:
+        images, labels = images_all[mask], labels_all[mask]
+    labels = labels.astype(numpy.int8).reshape(-1, 1)
 
-    ind = [ k for k in range(size) if lbl[k] in digits ]
-    N = len(ind)
+    return images, labels
 
-    images = numpy.zeros((N, rows, cols), dtype=numpy.uint8)
-    labels = numpy.zeros((N, 1), dtype=numpy.int8)
-    for i in range(len(ind)):
-        images[i] = numpy.array(img[ ind[i]*rows*cols : (ind[i]+1)*rows*cols ]).reshape((rows, cols))
-        labels[i] = lbl[ind[i]]
+# Same as load_mnist, but each image is a flat uint8 vector (length = 28 x 28 = 784) and labels is a 1-d array of
+# the digits.  Scaling the pixels to floats is left to the user of the cases (see Caseman's scale argument), so
+# the full data set never has to be held as floats.
 
-    return images, labels
+def load_flat_mnist(dataset="training", digits=numpy.arange(10), path= __mnist_path__):
+    images, labels = load_mnist(dataset, digits=digits, path=path)
+    return images.reshape(len(images), -1), labels.reshape(-1)
 
 # *****   Viewing images *******
 #  These two functions assume that the image is in the standard MNIST format: a 2-d numpy array.
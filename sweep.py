@@ -0,0 +1,206 @@
+import matplotlib
+matplotlib.use('Agg')  # Workers only save figures, never show them.  This must come before pyplot is imported.
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import queue
+import shlex
+import time
+import numpy
+import argument_parser
+import main
+import tflowtools as TFT
+
+# ******* HYPERPARAMETER SWEEPS ********
+# Runs many configurations of main.py (each one a list of its command-line arguments) on a pool of worker processes,
+# so TensorFlow is imported once per worker instead of once per configuration.  The configurations come either
+# from a settings.txt-style file (one "python3 main.py ..." line per configuration) or from a grid: a base
+# configuration plus a list of alternatives for some of its options, e.g.
+#        python3 sweep.py --base "--source parity ... --steps 1000" --grid lrate=0.001,0.01 "dims=100,50 50"
+# Each worker limits the threads of its TensorFlow sessions to its share of the cores, and with --pin it is bound to
+# cores of its own.  As TensorFlow sizes its thread pools once per process, this is done once, when the worker
+# starts, and the configurations can not set --intra, --inter or --affinity themselves.  Independent ops get more
+# than one thread only when some configuration has --towers > 1.  All configurations use the data set cache (see
+# data_cache), which is filled before the workers start, so they share the same memory-mapped cases.  The final
+# results of all configurations are written to one tab-separated table.
+# With --folds k, every configuration is cross-validated: it runs k times, holding out a different stratified fold
+# each time (see --folds and --fold of main.py), all k runs going to the pool at once.  The table then also gets,
+# for each configuration, a row with the mean and a row with the standard deviation of its folds' results.
+
+__sweep_dir__ = "sweep/"  # Each configuration keeps its tensorboard logs and checkpoints in a numbered subdirectory
+__columns__ = ['config', 'fold', 'status', 'error', 'validation_error', 'training_accuracy', 'testing_accuracy',
+               'seconds', 'args']
+__measures__ = ['error', 'validation_error', 'training_accuracy', 'testing_accuracy', 'seconds']
+__worker_threads__ = None  # The (intra, inter) thread counts of this worker's sessions, set by init_worker
+
+# The arguments of each "python3 main.py ..." line of a settings file.  Other lines (e.g. comments) are skipped.
+def read_settings(path):
+    configs = []
+    with open(path) as file:
+        for line in file:
+            words = shlex.split(line, comments=True)
+            if len(words) > 1 and words[1] == 'main.py':
+                configs.append(words[2:])
+    return configs
+
+# One configuration per combination of alternatives.  Each option is a string like "lrate=0.001,0.01", whose
+# alternatives are separated by commas and may hold several values ("dims=100,50 50").  As argparse keeps the last
+# occurrence of an option, the alternatives are simply appended to the base arguments.
+def gen_grid(base, options):
+    names, alternatives = [], []
+    for option in options:
+        name, values = option.split('=', 1)
+        names.append(name)
+        alternatives.append([value.split() for value in values.split(',')])
+    configs = []
+    for combination in itertools.product(*alternatives):
+        args = list(base)
+        for name, values in zip(names, combination):
+            args += ['--' + name] + values
+        configs.append(args)
+    return configs
+
+# Every configuration uses the data set cache.
+def with_defaults(args):
+    return args if '--cache' in args else args + ['--cache']
+
+# The value of the last occurrence of an option in a list of arguments, or None.
+def option_value(args, name):
+    values = [args[i + 1] for i in range(len(args) - 1) if args[i] == name]
+    return values[-1] if values else None
+
+# The session options that hold for a whole process are set by the sweep, not by its configurations.
+def check_configs(configs):
+    for args in configs:
+        for name in ('--intra', '--inter', '--affinity'):
+            if name in args:
+                print(name, "is set for every worker of a sweep, and can not be given by a configuration:", *args)
+                quit()
+
+# Runs once in each worker, before any configuration.  cpusets, when given, is a queue with one list of CPUs per
+# worker.  A worker that finds it empty (one started to replace a worker that died) is not pinned.
+def init_worker(intra, inter, cpusets=None):
+    global __worker_threads__
+    __worker_threads__ = (intra, inter)
+    TFT.set_session_config(TFT.gen_session_config(intra=intra, inter=inter))
+    if cpusets is not None:
+        try:
+            TFT.pin_cpus(cpusets.get(timeout=1))
+        except queue.Empty:
+            pass
+
+# Write the cached data set of every configuration that reads one, once per cache key, before the workers start.
+def fill_cache(configs):
+    keys = set()
+    for args in configs:
+        parser = argument_parser.argument_parser()
+        try:
+            parser.parse(args)
+            if parser.args.stream or parser.args.onthefly: continue
+            parser.precision_v = parser.precision()
+            parser.storage_v = parser.storage()
+            key = parser.cache_key()
+            if key not in keys:
+                keys.add(key)
+                parser.source()
+        except SystemExit:
+            continue  # Bad arguments are reported when the configuration runs
+
+# The jobs for the pool: (config, fold, args) triples, with k jobs per configuration when folds is k.
+def gen_jobs(configs, folds=None):
+    if not folds: return [(index, None, args) for index, args in enumerate(configs)]
+    return [(index, fold, args + ['--folds', str(folds), '--fold', str(fold)])
+            for index, args in enumerate(configs) for fold in range(folds)]
+
+# Run one configuration (or one fold of it) in a worker.  A failure (including argument errors, which end with
+# quit()) is recorded in the status column instead of stopping the sweep.
+def run_config(job):
+    index, fold, args = job
+    start = time.time()
+    outdir = os.path.join(__sweep_dir__, str(index) if fold is None else str(index) + '-' + str(fold))
+    try:
+        results = main.run(args, view=False, outdir=outdir, threads=__worker_threads__)
+        status = 'ok'
+    except (Exception, SystemExit) as e:
+        results = {}
+        status = type(e).__name__ + ': ' + str(e)
+    results.update(config=index, fold=fold, status=status, args=' '.join(args))
+    results.setdefault('seconds', time.time() - start)
+    return results
+
+# A 'mean' and a 'std' row per configuration, over the folds that ran without failure.  The status tells how many.
+def aggregate_folds(results):
+    rows = []
+    for index in sorted(set(r['config'] for r in results)):
+        runs = [r for r in results if r['config'] == index and r['status'] == 'ok']
+        mean, std = {'config': index, 'fold': 'mean'}, {'config': index, 'fold': 'std'}
+        for measure in __measures__:
+            values = [r[measure] for r in runs if r.get(measure) is not None]
+            if values:
+                mean[measure], std[measure] = numpy.mean(values), numpy.std(values)
+        mean['status'] = std['status'] = str(len(runs)) + ' folds ok'
+        rows += [mean, std]
+    return rows
+
+# processes defaults to one per core (but no more than there are jobs); the cores are shared evenly between the
+# processes' TensorFlow sessions.  With pin, each process is bound to its own share of the cores.
+def sweep(configs, processes=None, out='sweep_results.tsv', folds=None, pin=False):
+    check_configs(configs)
+    jobs = len(configs) * (folds if folds else 1)
+    processes = processes if processes else min(jobs, os.cpu_count() or 1)
+    threads = max(1, (os.cpu_count() or 1) // processes)
+    towers = max(int(option_value(args, '--towers') or 1) for args in configs)
+    inter = threads if towers > 1 else 1  # Towers are independent ops, which would run one at a time on one thread
+    configs = [with_defaults(args) for args in configs]
+    fill_cache(configs)
+    context = multiprocessing.get_context('spawn')  # Fresh workers, rather than forks of a process that runs TF
+    cpusets = None
+    if pin:
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        cpusets = context.Queue()
+        for i in range(processes):
+            cpusets.put(cpus[(i * threads) % len(cpus):(i * threads) % len(cpus) + threads])
+    with context.Pool(processes, initializer=init_worker, initargs=(threads, inter, cpusets)) as pool:
+        results = list(pool.imap_unordered(run_config, gen_jobs(configs, folds)))
+    results.sort(key=(lambda r: (r['config'], r['fold'] if r['fold'] is not None else -1)))
+    write_results(results + (aggregate_folds(results) if folds else []), out)
+    return results
+
+def write_results(results, path):
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=__columns__, delimiter='\t', extrasaction='ignore')
+        writer.writeheader()
+        for r in results:
+            writer.writerow({c: ('' if r.get(c) is None else r[c]) for c in __columns__})
+    print(len(results), "rows of results written to", path)
+
+def parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--settings", required=False,
+            help="file with one 'python3 main.py <arguments>' line per configuration, like settings.txt")
+    parser.add_argument("--base", required=False,
+            help="arguments of main.py shared by all configurations of a grid, as one string")
+    parser.add_argument("--grid", nargs='+', required=False,
+            help="alternatives for options of the base configuration, e.g. lrate=0.001,0.01 'dims=100,50 50'")
+    parser.add_argument("--procs", type=int, required=False,
+            help="number of worker processes. Default is one per core")
+    parser.add_argument("--pin", action='store_true', required=False,
+            help="bind each worker process to its own share of the cores (Linux only)")
+    parser.add_argument("--folds", type=int, required=False,
+            help="cross-validate every configuration with this many folds, and report their mean and deviation")
+    parser.add_argument("--out", required=False, default='sweep_results.tsv',
+            help="file that the table of results is written to. Default is sweep_results.tsv")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse()
+    if args.settings:
+        configs = read_settings(args.settings)
+    elif args.base:
+        configs = gen_grid(shlex.split(args.base), args.grid if args.grid else [])
+    else:
+        print("Give either --settings or --base (with --grid)")
+        quit()
+    sweep(configs, processes=args.procs, out=args.out, folds=args.folds, pin=args.pin)
@@ -10,16 +10,48 @@ import scipy.cluster.hierarchy as SCH  # Needed for dendrograms
 import numpy.random as NPR
 
 # ****** SESSION HANDLING *******
+# Every session made here gets __session_config__ (None = TensorFlow's defaults), so that runs side by side (e.g. in
+# a sweep, see sweep.py) can each be held to their own share of the cores.
+
+__session_config__ = None
+
+# intra and inter are the sizes of the intra-op and inter-op thread pools (0 = as many as there are cores).
+# optlevel is the graph optimization level, 0 (L0: none) or 1 (L1: common subexpressions and constant folding), and
+# None leaves TensorFlow's default.  xla turns on XLA JIT compilation of the graph.
+def gen_session_config(intra=0, inter=0, optlevel=None, xla=False):
+    optimizer_options = tf.OptimizerOptions()
+    if optlevel is not None:
+        optimizer_options.opt_level = [tf.OptimizerOptions.L0, tf.OptimizerOptions.L1][optlevel]
+    if xla:
+        optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return tf.ConfigProto(intra_op_parallelism_threads=intra, inter_op_parallelism_threads=inter,
+                          graph_options=tf.GraphOptions(optimizer_options=optimizer_options))
+
+def set_session_config(config):
+    global __session_config__
+    __session_config__ = config
+
+# Restrict this process to the given CPUs.  This holds for the calling thread and every thread started after it
+# (such as TensorFlow's thread pools, which are made along with the first session), so call it early.  Linux only.
+def pin_cpus(cpus):
+    if not hasattr(os, 'sched_setaffinity'):
+        print("CPU affinity is not supported on this platform")
+        return
+    os.sched_setaffinity(0, cpus)
 
 def gen_initialized_session(dir='probeview'):
-    sess = tf.Session()
+    sess = tf.Session(config=__session_config__)
     sess.probe_stream = viewprep(sess,dir=dir)  # Create a probe stream and attach to the session
     sess.viewdir = dir  # add a second slot, viewdir, to the session
     sess.run(tf.global_variables_initializer())
     return sess
 
+# A plain session, without a probe stream, e.g. for background workers.
+def gen_session():
+    return tf.Session(config=__session_config__)
+
 def copy_session(sess1):
-    sess2 = tf.Session()
+    sess2 = tf.Session(config=__session_config__)
     sess2.probe_stream = sess1.probe_stream
     sess2.probe_stream.reopen()
     sess2.viewdir = sess1.viewdir
@@ -32,7 +64,7 @@ def close_session(sess, view=True):
 
 # Simple evaluator of a TF operator.
 def tfeval(operators):
-    sess = tf.Session()
+    sess = tf.Session(config=__session_config__)
     sess.run(tf.global_variables_initializer())
     result = sess.run(operators) # result = a list of output values, one from each operator.
     sess.close()
@@ -46,6 +78,15 @@ def viewprep(session, dir='probeview',flush=120,queue=10):
     clear_tensorflow_log(dir)  # Without this, the directory fills up with unusable files
     return tf.summary.FileWriter(dir,session.graph,flush_secs=flush,max_queue=queue)
 
+# A histogram summary built directly from an array of values, for writing with probe_stream.add_summary.
+def gen_histogram_summary(tag, values, bins=30):
+    counts, edges = np.histogram(values, bins=bins)
+    histo = tf.HistogramProto(min=float(np.min(values)), max=float(np.max(values)), num=len(values),
+                              sum=float(np.sum(values)), sum_squares=float(np.sum(np.square(values))))
+    histo.bucket_limit.extend(edges[1:])
+    histo.bucket.extend(counts)
+    return tf.Summary(value=[tf.Summary.Value(tag=tag, histo=histo)])
+
 # To view probes, the function graph, etc., do this at the command line:
 #        tensorboard --logdir=probeview
 # Then open a Chrome browser and go to site:  localhost:6006
@@ -61,18 +102,24 @@ def clear_tensorflow_log(logdir):
 
 # Generate all bit vectors of a given length (num_bits).
 def gen_all_bit_vectors(num_bits):
-    def bits(n):
-        s = bin(n)[2:]
-        return [int(b) for b in '0'*(num_bits - len(s))+s]
-    return [bits(i) for i in range(2**num_bits)]
+    return gen_bit_vector_array(num_bits).tolist()
 
 # Convert an integer to a bit vector of length num_bits, with prefix 0's as padding when necessary.
 def int_to_bits(i,num_bits):
-    s = bin(i)[2:]
-    return [int(b) for b in '0' * (num_bits - len(s)) + s]
+    return ints_to_bit_array(i,num_bits).tolist()
 
 def all_ints_to_bits(num_bits):
-    return [int_to_bits(i) for i in range(2**num_bits)]
+    return gen_all_bit_vectors(num_bits)
+
+# Array versions of the above: the bits of each integer are pulled out with one broadcast shift, so all 2**num_bits
+# vectors come back as the rows of a single uint8 array (most significant bit first).
+def ints_to_bit_array(ints,num_bits):
+    ints = np.asarray(ints, dtype=np.uint32 if num_bits <= 32 else np.uint64)
+    shifts = np.arange(num_bits - 1, -1, -1, dtype=ints.dtype)
+    return ((ints[...,None] >> shifts) & 1).astype(np.uint8)
+
+def gen_bit_vector_array(num_bits):
+    return ints_to_bit_array(np.arange(2**num_bits),num_bits)
 
 # Convert an integer k to a sparse vector in which all bits are "off" except the kth bit.  Note: this
 # is zero-based, so the one-hot vector for 0 is 10000..., and for 1 is 010000..
@@ -119,54 +166,76 @@ def gen_vector_shift_cases(vlen,count, dir=1,delta=1, density=0.5):
 
 # Given a density (fraction), this randomly places onvals to produce a vector with the desired density.
 def gen_dense_vector(size, density=.5, onval=1, offval=0):
-    a = [offval] * size
-    indices = np.random.choice(size,round(density*size),replace=False)
-    for i in indices: a[i] = onval
-    return a
+    return np.where(gen_dense_vector_array(1,size,[density])[0], onval, offval).tolist()
 
 def gen_random_density_vectors(count,size,density_range=(0,1)):
-    return [gen_dense_vector(size,density=np.random.uniform(*density_range)) for c in range(count)]
+    return gen_random_density_array(count,size,density_range=density_range).tolist()
+
+# Array versions: row r gets round(densities[r]*size) 1's at random places.  Each row gets a random key per cell,
+# and the cells whose keys fall below the row's k'th smallest key are turned on.
+def gen_dense_vector_array(count,size,densities):
+    on_counts = np.round(np.asarray(densities) * size).astype(int)
+    if size == 0: return np.zeros((count,0),dtype=np.uint8)
+    keys = np.random.uniform(size=(count,size))
+    limits = np.sort(keys,axis=1)[np.arange(count),np.minimum(on_counts,size-1)]
+    limits[on_counts >= size] = np.inf
+    return (keys < limits[:,None]).astype(np.uint8)
+
+def gen_random_density_array(count,size,density_range=(0,1)):
+    return gen_dense_vector_array(count,size,np.random.uniform(*density_range,size=count))
 
 # ***** SYMMETRIC VECTORS *****
 # Symmetric vectors are binary vectors that are symmetric about their midpoint.  For example:
 # 10011001, 01110 and 0001110111000 are symmetric.  Note that they can have even or odd length.
 
 def gen_symmetric_vector(len):
-    halflen = math.floor(len/2)
-    v1 = gen_dense_vector(halflen,density=NPR.uniform(0,1))
-    v2 = v1.copy()
-    v2.reverse()
-    v3 = v1 + v2
-    if (len % 2) == 1:
-        v3.insert(halflen,NPR.randint(0,2))  # Note that numpy.random's randint(0,k) uses k-1 as max int, not k.
-    return v3
+    return gen_symmetric_vector_array(len,1)[0].tolist()
 
 def check_vector_symmetry(v):
-    vlen = len(v)
-    for i in range(math.floor(vlen/2)):
-        if v[i] != v[vlen-1-i]:
-            return False
-    return True
+    return bool(check_vector_symmetries(np.array([v]))[0])
+
+# Array versions: symmetric vectors are built from a random half (of random density), its mirror image and, for
+# odd lengths, a random middle bit.  Anti-symmetric candidates are drawn in batches, and the ones that happen to be
+# symmetric are dropped, until there are enough of them.
+
+def gen_symmetric_vector_array(vlen,count):
+    half = gen_random_density_array(count,math.floor(vlen/2))
+    middle = NPR.randint(0,2,size=(count,vlen % 2)).astype(np.uint8)
+    return np.concatenate([half, middle, half[:,::-1]], axis=1)
+
+def check_vector_symmetries(vectors):
+    return (vectors == vectors[:,::-1]).all(axis=1)
+
+def gen_anti_symmetric_vector_array(vlen,count):
+    batches = [np.zeros((0,vlen),dtype=np.uint8)]; found = 0
+    while found < count:
+        candidates = gen_random_density_array(count - found,vlen)
+        candidates = candidates[~check_vector_symmetries(candidates)]
+        batches.append(candidates); found += len(candidates)
+    return np.concatenate(batches)
+
+# Returns (features, labels), with label 1 for symmetric and 0 for anti-symmetric vectors, in random order.  With
+# onehot=True, the labels are one-hot vectors (1 = [0,1]).
+def gen_symvect_arrays(vlen,count,onehot=False):
+    s1 = math.floor(count/2); s2 = count - s1
+    features = np.concatenate([gen_symmetric_vector_array(vlen,s1), gen_anti_symmetric_vector_array(vlen,s2)])
+    labels = np.concatenate([np.ones(s1,dtype=np.uint8), np.zeros(s2,dtype=np.uint8)])
+    order = NPR.permutation(count)
+    if onehot: labels = np.eye(2, dtype=np.uint8)[labels]
+    return features[order], labels[order]
 
 # This produces a set of symmetric vectors and appends the class label onto the end (for ease of use in ML).
 
 def gen_symvect_cases(vlen,count,label=1):
-    return [gen_symmetric_vector(vlen) + [label] for i in range(count)]
+    return [v + [label] for v in gen_symmetric_vector_array(vlen,count).tolist()]
 
 def gen_anti_symvect_cases(vlen,count,label=0):
-    cases = []
-    while len(cases) < count:
-        v = gen_dense_vector(vlen,density=NPR.uniform(0,1))
-        if not(check_vector_symmetry(v)):
-            cases.append(v+[label])
-    return cases
+    return [v + [label] for v in gen_anti_symmetric_vector_array(vlen,count).tolist()]
 
 # Generate a dataset with an equal (or nearly so if vlen is odd) number of symmetric and anti-symmetric bit vectors
 def gen_symvect_dataset(vlen,count):
-    s1 = math.floor(count/2); s2 = count - s1
-    cases = gen_symvect_cases(vlen,s1) + gen_anti_symvect_cases(vlen,s2)
-    NPR.shuffle(cases)
-    return cases
+    features, labels = gen_symvect_arrays(vlen,count)
+    return np.concatenate([features, labels[:,None]], axis=1).tolist()
 
 # ****** LINES (horiz and vert) in arrays *********
 
@@ -198,32 +267,49 @@ def gen_all_one_hot_cases(len, floats=False):
 def gen_dense_autoencoder_cases(count,size,dr=(0,1)):
     return [[v,v] for v in gen_random_density_vectors(count,size,density_range=dr)]
 
+def gen_dense_autoencoder_arrays(count,size,dr=(0,1)):
+    vectors = gen_random_density_array(count,size,density_range=dr)
+    return vectors, vectors
+
 # Produce a list of pairs, with each pair consisting of a num_bits bit pattern and a singleton list containing
 # the parity bit: 0 => an even number of 1's, 1 => odd number of 1's.  When double=True, a 2-bit vector is the
 # target, with bit 0 indicating even parity and bit 1 indicating odd parity.
 
 def gen_all_parity_cases(num_bits, double=True):
-    def parity(v): return sum(v) % 2
-    def target(v):
-        if double:
-            tg = [0,0].copy()
-            tg[parity(v)] = 1
-            return tg
-        else: return [parity(v)]
+    return arrays_to_cases(*gen_parity_arrays(num_bits, double=double))
+
+# Array version: returns (features, targets), one row per case.
+def gen_parity_arrays(num_bits, double=True):
+    features = gen_bit_vector_array(num_bits)
+    return features, gen_parity_targets(features, double=double)
+
+# Count random bit vectors (with repeats) instead of all of them, e.g. for generating fresh cases during training.
+def gen_random_parity_arrays(count, num_bits, double=True):
+    features = NPR.randint(0, 2, size=(count, num_bits)).astype(np.uint8)
+    return features, gen_parity_targets(features, double=double)
+
+def gen_parity_targets(features, double=True):
+    parity = features.sum(axis=1) % 2
+    return np.eye(2, dtype=np.uint8)[parity] if double else parity[:,None].astype(np.uint8)
 
-    return [[c, target(c)] for c in gen_all_bit_vectors(num_bits)]
+# Convert a (features, targets) pair of arrays into the list of [features, target] pairs used by the list versions.
+def arrays_to_cases(features, targets):
+    return [[f, t] for f, t in zip(features.tolist(), targets.tolist())]
 
 # This produces "count" cases, where features = random bit vectors and target = a one-hot vector indicating
 # the number of 1's in the feature vector(default) or simply the count label.  Note that the target vector is one bit
 # larger than the feature vector to account for the case of a zero-sum feature vector.
 
 def gen_vector_count_cases(num,size,drange=(0,1),random=True,poptarg=True):
-    if random: feature_vectors = gen_random_density_vectors(num,size,density_range=drange)
-    else: feature_vectors = gen_all_bit_vectors(size)
-    if poptarg:
-        targets = [int_to_one_hot(sum(fv),size+1) for fv in feature_vectors]
-    else: targets = [sum(fv) for fv in feature_vectors]
-    return [[fv,targ] for fv,targ in zip(feature_vectors,targets)]
+    return arrays_to_cases(*gen_vector_count_arrays(num,size,drange=drange,random=random,poptarg=poptarg))
+
+# Array version: returns (features, targets), where targets is 1-d (the counts) when poptarg=False.
+def gen_vector_count_arrays(num,size,drange=(0,1),random=True,poptarg=True):
+    if random: features = gen_random_density_array(num,size,density_range=drange)
+    else: features = gen_bit_vector_array(size)
+    counts = features.sum(axis=1)
+    targets = np.eye(size+1, dtype=np.uint8)[counts] if poptarg else counts
+    return features, targets
 
 def gen_all_binary_count_cases(size,poptarg=True): return gen_vector_count_cases(None,size,random=False,poptarg=poptarg)
 
@@ -297,20 +383,62 @@ def gen_segment_locs(maxlen,seg_sizes):
 # population-coded (i.e. one-hot) vector will be created as the target vector for each case.
 
 def gen_segmented_vector_cases(vectorlen,count,minsegs,maxsegs,poptargs=True):
-    cases = []
-    for c in range(count):
-        numsegs = NPR.randint(minsegs,maxsegs+1)
-        v = gen_segmented_vector(vectorlen,numsegs)
-        case = [v,int_to_one_hot(numsegs-minsegs,maxsegs-minsegs+1)] if poptargs else [v,numsegs]
-        cases.append(case)
-    return cases
+    return arrays_to_cases(*gen_segmented_vector_arrays(vectorlen,count,minsegs,maxsegs,poptargs=poptargs))
+
+# Array version of gen_segmented_vector_cases, which draws the cases from the same distribution as the functions
+# above, but for all cases at once: the segment counts, chunk sizes and cut points (by Floyd's sampling algorithm,
+# one step per cut for all rows) are drawn as arrays, and the loop over segments in gen_segment_locs becomes a loop
+# over segment positions in which rows with fewer segments simply sit out.  The segments are then written into
+# one 2-d array as +1/-1 marks at their starts/ends, followed by a cumulative sum along each row.
+
+def gen_segmented_vector_arrays(vectorlen,count,minsegs,maxsegs,poptargs=True,onval=1,offval=0):
+    if vectorlen < 2*maxsegs - 1:
+        raise ValueError("vectors of length " + str(vectorlen) + " have no room for " + str(maxsegs) + " segments")
+    numsegs = NPR.randint(minsegs,maxsegs+1,size=count)
+    active = numsegs > 0
+    chunk_sizes = np.where(active, NPR.randint(numsegs, vectorlen - numsegs + 2), 0)
+    seg_sizes = gen_random_piece_array(chunk_sizes,numsegs,max(maxsegs,1))
+    marks = np.zeros((count,vectorlen+1),dtype=np.int8)
+    rows = np.arange(count); remains = chunk_sizes.copy(); gaps = numsegs - 1; start_min = np.zeros(count,dtype=int)
+    for i in range(maxsegs):
+        live = i < numsegs
+        sizes = seg_sizes[:,i]
+        space = remains + gaps
+        starts = NPR.randint(start_min, np.where(live, vectorlen - space + 1, start_min + 1))
+        marks[rows[live], starts[live]] = 1  # Segments are separated by gaps, so no two marks share a cell
+        marks[rows[live], starts[live] + sizes[live]] = -1
+        remains -= sizes; start_min = starts + sizes + 1; gaps -= 1
+    on = np.cumsum(marks[:,:vectorlen],axis=1) > 0
+    vectors = np.where(on, onval, offval)
+    targets = np.eye(maxsegs-minsegs+1,dtype=np.uint8)[numsegs-minsegs] if poptargs else numsegs
+    return vectors, targets
+
+# For each row, randomly divide chunk_sizes[row] units into num_pieces[row] units, as gen_random_pieces does.  The
+# result has width columns; the pieces of each row come first, followed by zeros.
+def gen_random_piece_array(chunk_sizes,num_pieces,width):
+    count = len(chunk_sizes)
+    n = chunk_sizes - 1; m = np.maximum(num_pieces - 1, 0)  # Choose m cut points from 1..n
+    cuts = np.zeros((count,width-1),dtype=int)
+    for i in range(width-1):  # Floyd's algorithm: step i draws t from 1..j, with j = n-m+1+i, and keeps j if t is taken
+        live = i < m
+        j = np.where(live, n - m + 1 + i, 1)
+        t = NPR.randint(1, j + 1)
+        taken = (cuts == t[:,None]).any(axis=1)
+        cuts[:,i] = np.where(live, np.where(taken, j, t), 0)
+    cuts = np.where(np.arange(width-1) < m[:,None], cuts, chunk_sizes[:,None])
+    cuts.sort(axis=1)
+    bounds = np.concatenate([np.zeros((count,1),dtype=int), cuts, chunk_sizes[:,None]], axis=1)
+    return np.diff(bounds,axis=1)
 
 def segment_count(vect,onval=1,offval=0):
-    lastval = offval; count = 0
-    for elem in vect:
-        if elem == onval and lastval == offval: count += 1
-        lastval = elem
-    return count
+    return int(segment_counts(np.array([vect]),onval=onval,offval=offval)[0])
+
+# Vectorized segment_count for the rows of a 2-d array: a segment starts wherever onval follows offval (or begins the
+# row).
+def segment_counts(vectors,onval=1,offval=0):
+    vectors = np.asarray(vectors)
+    previous = np.concatenate([np.full((len(vectors),1),offval,dtype=vectors.dtype), vectors[:,:-1]], axis=1)
+    return ((vectors == onval) & (previous == offval)).sum(axis=1)
 
 # This produces a string consisting of the binary vector followed by the segment count surrounded by a few symbols
 # and/or blanks.  These strings are useful to use as labels during dendrogram plots, for example.
@@ -346,8 +474,9 @@ def simple_plot(yvals,xvals=None,xtitle='X',ytitle='Y',title='Y = F(X)'):
     PLT.xlabel(xtitle); PLT.ylabel(ytitle); PLT.title(title)
     PLT.draw()
 
-# Each history is a list of pairs (timestamp, value).
-def plot_training_history(error_hist,validation_hist=[],xtitle="Epoch",ytitle="Error",title="History",fig=True):
+# Each history is a list of pairs (timestamp, value).  labels, when given, names the two histories in a legend.
+def plot_training_history(error_hist,validation_hist=[],xtitle="Epoch",ytitle="Error",title="History",fig=True,
+                          labels=None):
     PLT.ion()
     if fig: PLT.figure()
     if len(error_hist) > 0:
@@ -355,6 +484,8 @@ def plot_training_history(error_hist,validation_hist=[],xtitle="Epoch",ytitle="E
         PLT.hold(True)
     if len(validation_hist) > 0:
         simple_plot([p[1] for p in validation_hist], [p[0] for p in validation_hist])
+    if labels:
+        PLT.legend([l for l, h in zip(labels, (error_hist, validation_hist)) if len(h) > 0])
     PLT.ioff()
 
 # alpha = transparency